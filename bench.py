@@ -0,0 +1,607 @@
+"""Replay benchmark for bot.py.
+
+Drives the real handlers with synthetic Telegram updates (registrations with
+referral args, catalog browsing, /promo, buy: callbacks), signed Lava webhooks
+and a broadcast, against a local fake Bot API / Lava stub running in a child
+process. The database is a fresh temp file seeded at the requested size.
+
+    python bench.py --users 10000 --new-users 2000 --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json --fail-on-regression 20
+    python bench.py --startup 5 --new-users 0
+    python bench.py --sizes 10000,100000,1000000
+    python bench.py --workers 0,1,2,4 --tg-latency 0.02
+    python bench.py --import-items 50000
+
+Before/after for the pooled DB layer: run once with --legacy-db --save-baseline
+before.json (a new sqlite connection per query, executed on the event loop, as
+bot.py did originally), then again with --baseline before.json.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+NEW_USER_BASE = 10_000_000
+PROMO_CODE = 'BENCH10'
+
+# --- Fake Bot API + Lava stub (child process) ---
+def run_fake_api(port: int, lava_latency: float, tg_latency: float) -> None:
+    from aiohttp import web
+
+    me = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+    counter = iter(range(1, 1 << 62))
+    calls: dict = {}  # вызовы Bot API по методам — по ним --workers считает обработанные апдейты
+
+    def message(chat_id) -> dict:
+        return {'message_id': next(counter), 'date': int(time.time()), 'text': '',
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}}
+
+    async def bot_api(request):
+        method = request.match_info['method']
+        data = await request.json() if request.content_type == 'application/json' else dict(await request.post())
+        calls[method] = calls.get(method, 0) + 1
+        if tg_latency:
+            await asyncio.sleep(tg_latency)
+        if method == 'getMe':
+            result = me
+        elif method == 'sendMediaGroup':
+            result = [message(data.get('chat_id'))]
+        elif method.startswith(('send', 'edit', 'copy', 'forward')):
+            result = message(data.get('chat_id'))
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def lava_invoice(request):
+        data = await request.json()
+        if lava_latency:
+            await asyncio.sleep(lava_latency)
+        return web.json_response({'status': 200, 'data': {'id': f"inv-{data['orderId']}",
+                                                          'url': f"https://pay.example/{data['orderId']}"}})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', bot_api)
+    app.router.add_post('/business/invoice/create', lava_invoice)
+    app.router.add_get('/stats', lambda request: web.json_response(calls))
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+# --- Synthetic updates ---
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def _next(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, tg_id: int, text: str) -> dict:
+        msg = {'message_id': self._next(), 'date': int(time.time()), 'text': text,
+               'chat': {'id': tg_id, 'type': 'private'},
+               'from': {'id': tg_id, 'is_bot': False, 'first_name': f'u{tg_id}', 'username': f'u{tg_id}'}}
+        if text.startswith('/'):
+            msg['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self.update_id, 'message': msg}
+
+    def callback(self, tg_id: int, data: str) -> dict:
+        uid = self._next()
+        return {'update_id': uid, 'callback_query': {
+            'id': str(uid), 'chat_instance': str(tg_id), 'data': data,
+            'from': {'id': tg_id, 'is_bot': False, 'first_name': f'u{tg_id}'},
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': tg_id, 'type': 'private'}, 'text': ''}}}
+
+# --- Seeding ---
+def seed(bot, users: int, products: int, orders: int) -> None:
+    bot.init_db()
+    conn = bot._db_connect()
+    now = datetime.utcnow()
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO products (name, price, photo) VALUES (?, ?, ?)',
+                     [(f'Товар {i}', 100 + i * 10, f'photo-{i}' if i % 2 else None) for i in range(products)])
+    conn.executemany('INSERT INTO users (tg_id, username, registered_at, balance, invited_by) VALUES (?, ?, ?, 0, ?)',
+                     [(i, f'u{i}', (now - timedelta(days=i % 90)).isoformat(), random.randint(1, i - 1) if i > 1 and i % 3 == 0 else None)
+                      for i in range(1, users + 1)])
+    statuses = ('done', 'done', 'paid', 'in_progress', 'expired')
+    conn.executemany('INSERT INTO orders (user_id, product_id, price, status, created_at) VALUES (?, ?, ?, ?, ?)',
+                     [(random.randint(1, users), random.randint(1, products), 100, random.choice(statuses),
+                       (now - timedelta(minutes=i)).isoformat()) for i in range(orders)])
+    conn.execute('INSERT INTO promocodes (code, discount_percent, activations_left) VALUES (?, 10, ?)', (PROMO_CODE, 1 << 30))
+    conn.execute('COMMIT')
+    conn.close()
+
+# --- Measurement ---
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def histogram_seconds(bot, *names: str) -> float:
+    return sum(h[-1] for name in names for h in bot.metrics.histogram(name).values())
+
+def db_seconds(bot) -> float:
+    return histogram_seconds(bot, 'db_query_seconds', 'db_transaction_seconds')
+
+def handler_errors(bot) -> float:
+    return sum(v for (name, _), v in bot.metrics._counters.items() if name == 'bot_handler_errors_total')
+
+def install_legacy_db(bot) -> None:
+    """Replaces the pooled DB layer with a connection per call, run directly on the event loop."""
+    def connect():
+        return sqlite3.connect(bot.DB_PATH, timeout=30, isolation_level=None)
+
+    async def db_execute(query: str, params: tuple = (), fetch: bool = False):
+        started = time.perf_counter()
+        conn = connect()
+        try:
+            cur = conn.execute(query, params)
+            return cur.fetchall() if fetch else None
+        finally:
+            conn.close()
+            bot.metrics.observe('db_query_seconds', time.perf_counter() - started, query=bot.query_shape(query))
+
+    async def db_transaction(fn, *args):
+        started = time.perf_counter()
+        conn = connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(conn, *args)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            return result
+        finally:
+            conn.close()
+            bot.metrics.observe('db_transaction_seconds', time.perf_counter() - started, fn=fn.__name__)
+
+    bot.db_execute, bot.db_transaction = db_execute, db_transaction
+
+async def _loop_lag(samples: list, interval: float = 0.005) -> None:
+    # Насколько позже запланированного просыпается таймер — мера блокировок event loop
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+async def run_phase(bot, name: str, jobs: list, concurrency: int) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    latencies, lag = [], []
+
+    async def one(job):
+        async with sem:
+            started = time.perf_counter()
+            await job()
+            latencies.append(time.perf_counter() - started)
+
+    db_before, errors_before = db_seconds(bot), handler_errors(bot)
+    handlers_before = histogram_seconds(bot, 'bot_handler_seconds')
+    started = time.perf_counter()
+    monitor = asyncio.create_task(_loop_lag(lag))
+    await asyncio.gather(*(one(job) for job in jobs))
+    monitor.cancel()
+    wall = time.perf_counter() - started
+    # Доля БД считается от времени внутри хендлеров (без ожидания в очереди); для вебхуков — от ответа сервера
+    busy = histogram_seconds(bot, 'bot_handler_seconds') - handlers_before or sum(latencies)
+    result = {'count': len(jobs), 'seconds': wall, 'throughput': len(jobs) / wall if wall else 0.0,
+              'p50_ms': 1000 * percentile(latencies, 0.5), 'p99_ms': 1000 * percentile(latencies, 0.99),
+              'db_share': (db_seconds(bot) - db_before) / busy if busy else 0.0,
+              'loop_lag_ms': 1000 * max(lag, default=0.0),
+              'errors': handler_errors(bot) - errors_before,
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    print(f"{name:<12} {result['count']:>7} {result['throughput']:>10.1f}/s {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+          f"{100 * result['db_share']:>7.1f}% {result['loop_lag_ms']:>8.1f} {result['peak_rss_mb']:>8.1f} {int(result['errors']):>6}")
+    return result
+
+async def bench(bot, args) -> dict:
+    from aiohttp import ClientSession, web
+    from telegram import Update
+
+    app = bot.build_application(with_updater=False)
+    await app.initialize()
+    await app.start()
+    bot.tg_app = app
+    bot.outbox = bot.OutboundQueue(app.bot)
+    # Заглушка не ограничивает скорость — меряем сам бот, а не лимиты Telegram
+    bot.outbox.bucket = bot.TokenBucket(args.tg_rate)
+    server = web.Application()
+    server.router.add_post('/webhook/{provider}', bot.handle_payment_webhook)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port + 1).start()
+    consumer = asyncio.create_task(bot.inbox_consumer())
+
+    factory = UpdateFactory()
+    products = [row[0] for row in await bot.catalog.items()]
+    new_users = [NEW_USER_BASE + i for i in range(args.new_users)]
+
+    def replay(data: dict):
+        async def job():
+            update = Update.de_json(data, app.bot)
+            await app.update_processor.process_update(update, app.process_update(update))
+        return job
+
+    results = {}
+    print(f"{'scenario':<12} {'count':>7} {'throughput':>12} {'p50 ms':>9} {'p99 ms':>9} {'db':>8} {'lag ms':>8} {'rss MB':>8} {'errors':>6}")
+    try:
+        results['register'] = await run_phase(bot, 'register', [
+            replay(factory.message(tg, f'/start {random.randint(1, args.users)}' if args.users and i % 2 else '/start'))
+            for i, tg in enumerate(new_users)], args.concurrency)
+        browse = []
+        for tg in new_users:
+            browse.append(replay(factory.message(tg, '📦 Каталог')))
+            browse.append(replay(factory.callback(tg, f'cat:{random.randint(0, 3)}')))
+            browse.append(replay(factory.message(tg, '💰 Баланс')))
+        random.shuffle(browse)
+        results['browse'] = await run_phase(bot, 'browse', browse, args.concurrency)
+        results['promo'] = await run_phase(bot, 'promo', [
+            replay(factory.message(tg, f'/promo {PROMO_CODE}')) for tg in new_users[::2]], args.concurrency)
+        results['buy'] = await run_phase(bot, 'buy', [
+            replay(factory.callback(tg, f'buy:{random.choice(products)}')) for tg in new_users], args.concurrency)
+
+        pending = await bot.db_execute("SELECT id, price FROM orders WHERE status='pending_payment'", fetch=True)
+        async with ClientSession() as session:
+            def webhook(order_id: int, price: float):
+                body = json.dumps({'orderId': order_id, 'status': 'success', 'invoice_id': f'inv-{order_id}', 'sum': price}).encode()
+                sig = hmac.new(bot.LAVA_SECRET_KEY.encode(), msg=body, digestmod=hashlib.sha256).hexdigest()
+
+                async def job():
+                    async with session.post(f'http://127.0.0.1:{args.port + 1}/webhook/lava', data=body,
+                                            headers={'Signature': sig, 'Content-Type': 'application/json'}) as resp:
+                        await resp.read()
+                return job
+            results['webhook'] = await run_phase(bot, 'webhook', [webhook(oid, price) for oid, price in pending], args.concurrency)
+
+        # Оплаты применяются фоновым обработчиком inbox — ждём, пока он всё разберёт
+        started = time.perf_counter()
+        while (await bot.db_execute('SELECT COUNT(*) FROM webhook_inbox WHERE processed_at IS NULL', fetch=True))[0][0]:
+            await asyncio.sleep(0.05)
+        settle = time.perf_counter() - started
+        paid = (await bot.db_execute("SELECT COUNT(*) FROM orders WHERE status='paid' AND id IN (SELECT order_id FROM payment_events)",
+                                     fetch=True))[0][0]
+        print(f"payments applied: {paid}/{len(pending)}, inbox drained {settle:.2f}s after the last webhook")
+
+        if args.broadcast:
+            broadcast_id, total = await bot.db_transaction(bot._create_broadcast_tx, 'bench', 0)
+            engine = bot.BroadcastEngine(app.bot, rate=args.tg_rate)
+            started = time.perf_counter()
+            await engine.run(broadcast_id)
+            wall = time.perf_counter() - started
+            results['broadcast'] = {'count': total, 'seconds': wall, 'throughput': total / wall if wall else 0.0,
+                                    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+            print(f"{'broadcast':<12} {total:>7} {results['broadcast']['throughput']:>10.1f}/s")
+    finally:
+        consumer.cancel()
+        await runner.cleanup()
+        await bot.outbox.close()
+        await bot.lava.close()
+        await app.stop()
+        await app.shutdown()
+    return results
+
+# --- Startup ---
+def _poll(url: str, data: bytes = None, deadline: float = 30) -> bool:
+    """Waits until url answers; with data, until it answers 200 to a POST."""
+    end = time.perf_counter() + deadline
+    while time.perf_counter() < end:
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=1) as resp:
+                if resp.status == 200 or data is None:
+                    return True
+        except urllib.error.HTTPError:
+            if data is None:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.005)
+    return False
+
+def measure_startup(args, db_path: str) -> dict:
+    """Starts `bot.py run` in webhook mode and times first HTTP answer, first accepted update and shutdown."""
+    port = args.port + 2
+    env = dict(os.environ, DB_PATH=db_path, BOT_MODE='webhook', BOT_WORKERS='0', WEBHOOK_PORT=str(port),
+               WEBHOOK_HOST=f'http://127.0.0.1:{port}')
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'), 'run'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        http_ok = _poll(f'http://127.0.0.1:{port}/metrics')
+        http = time.perf_counter() - started
+        ready_ok = _poll(f'http://127.0.0.1:{port}/tg_webhook', data=b'{"update_id": 0}')
+        ready = time.perf_counter() - started
+        if not (http_ok and ready_ok):
+            raise RuntimeError("bot did not start, run it by hand with the same environment to see why")
+        stopping = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(30)
+        return {'http_ms': 1000 * http, 'ready_ms': 1000 * ready, 'shutdown_ms': 1000 * (time.perf_counter() - stopping)}
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+def run_startup(args, workdir: str) -> dict:
+    db_path = os.path.join(workdir, 'startup.db')
+    results = {'startup_fresh': measure_startup(args, db_path)}
+    runs = [measure_startup(args, db_path) for _ in range(args.startup)]
+    results['startup'] = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+    print(f"{'startup':<12} {'http ms':>9} {'ready ms':>9} {'stop ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<14} {r['http_ms']:>7.0f} {r['ready_ms']:>9.0f} {r['shutdown_ms']:>9.0f}")
+    return results
+
+# --- Data size ---
+# (name, запрос, параметры по размеру таблиц): горячие выборки, которые должны оставаться плоскими с ростом данных
+LOOKUPS = (
+    ('profile', 'SELECT id, pubg_id, balance, (SELECT COUNT(*) FROM users r WHERE r.invited_by = u.tg_id) FROM users u WHERE tg_id=?',
+     lambda n: (random.randint(1, n),)),
+    ('my_orders', 'SELECT id, price, status FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 5', lambda n: (random.randint(1, n),)),
+    ('promo_used', 'SELECT 1 FROM used_promocodes WHERE user_id=? AND code=?', lambda n: (random.randint(1, n), PROMO_CODE)),
+    ('workers', 'SELECT worker_id, worker_username FROM order_workers WHERE order_id=? ORDER BY id', lambda n: (random.randint(1, n),)),
+    ('admin_page', 'SELECT o.id, o.status, o.price, o.created_at, o.pubg_id, u.username FROM orders o '
+                   'LEFT JOIN users u ON u.id = o.user_id WHERE o.status=? AND o.id<? ORDER BY o.id DESC LIMIT 10',
+     lambda n: ('paid', random.randint(1, n))),
+)
+
+def run_sizes(bot, args, workdir: str) -> dict:
+    """Seeds users and orders at each size and times the hot lookups on one connection (median, microseconds)."""
+    results = {}
+    for size in args.sizes:
+        bot.close_db()
+        bot.DB_PATH = os.path.join(workdir, f'size-{size}.db')
+        started = time.perf_counter()
+        seed(bot, size, args.products, size)
+        conn = bot._db_connect()
+        conn.execute('ANALYZE')
+        print(f"seeded {size} users and orders in {time.perf_counter() - started:.1f}s")
+        row = {}
+        for name, query, params in LOOKUPS:
+            timings = []
+            for _ in range(args.lookups):
+                values = params(size)
+                started = time.perf_counter()
+                conn.execute(query, values).fetchall()
+                timings.append(time.perf_counter() - started)
+            row[f'{name}_us'] = 1e6 * statistics.median(timings)
+        conn.close()
+        results[f'size_{size}'] = row
+    sizes = [f'size_{size}' for size in args.sizes]
+    print(f"\n{'lookup, us':<12}" + ''.join(f"{size:>10}" for size in args.sizes) + f"{'x':>7}")
+    for name, _, _ in LOOKUPS:
+        values = [results[s][f'{name}_us'] for s in sizes]
+        print(f"{name:<12}" + ''.join(f"{v:>10.1f}" for v in values) + f"{values[-1] / values[0]:>7.2f}")
+    return results
+
+# --- Catalog import ---
+def _catalog_items(count: int, changed: int = 0) -> list:
+    # Первые changed позиций с новой ценой и остатком — частичное обновление прайса
+    return [{'id': f'sku-{i}', 'name': f'Товар {i}', 'price': 100 + i % 900 + (5 if i < changed else 0),
+             'currency': 'RUB', 'old_price': None, 'desc': f'Описание товара {i}', 'category': f'cat-{i % 20}',
+             'photo_file_id': None, 'stock': (i % 50) + (1 if i < changed else 0), 'delivery_text': None,
+             'extra': {'region': 'ru', 'weight': i % 7}} for i in range(count)]
+
+def _write_catalog(path: str, items: list) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            f.writelines(json.dumps(item, ensure_ascii=False) + '\n' for item in items)
+        else:
+            json.dump(items, f, ensure_ascii=False)
+
+def run_import(bot, args, workdir: str) -> dict:
+    """Times import_catalog on N items: first import, unchanged re-import and a partial change, for items.json and JSONL."""
+    results = {}
+    count, changed = args.import_items, max(1, args.import_items // 10)
+    for fmt in ('json', 'jsonl'):
+        bot.close_db()
+        bot.DB_PATH = os.path.join(workdir, f'import-{fmt}.db')
+        bot.init_db()
+        full, partial = os.path.join(workdir, f'items.{fmt}'), os.path.join(workdir, f'items-changed.{fmt}')
+        _write_catalog(full, _catalog_items(count))
+        _write_catalog(partial, _catalog_items(count, changed))
+        row = {}
+        for phase, path in (('first', full), ('unchanged', full), ('partial', partial)):
+            started = time.perf_counter()
+            stats = bot.import_catalog(path)
+            elapsed = time.perf_counter() - started
+            row[f'{phase}_s'] = elapsed
+            row[f'{phase}_items_per_s'] = count / elapsed
+            row[f'{phase}_written'] = stats['inserted'] + stats['updated']
+        results[f'import_{fmt}'] = row
+    results['import_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{'import ' + str(count):<14} {'first s':>9} {'unchanged s':>12} {'partial s':>10} {'written':>16}")
+    for fmt in ('json', 'jsonl'):
+        r = results[f'import_{fmt}']
+        written = f"{r['first_written']}/{r['unchanged_written']}/{r['partial_written']}"
+        print(f"{fmt:<14} {r['first_s']:>9.2f} {r['unchanged_s']:>12.2f} {r['partial_s']:>10.2f} {written:>16}")
+    print(f"peak RSS {results['import_peak_rss_mb']:.0f} MB")
+    return results
+
+# --- Worker scaling ---
+def _api_calls(args, method: str) -> int:
+    with urllib.request.urlopen(f'http://127.0.0.1:{args.port}/stats', timeout=5) as resp:
+        return json.load(resp).get(method, 0)
+
+async def _post_updates(url: str, bodies: list, concurrency: int) -> None:
+    from aiohttp import ClientSession, TCPConnector
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        async def post(body: bytes):
+            async with session.post(url, data=body, headers={'Content-Type': 'application/json'}) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    raise RuntimeError(f"webhook answered {resp.status}")
+        await asyncio.gather(*(post(body) for body in bodies))
+
+def _replay_replies(args, url: str, bodies: list, deadline: float = 120) -> float:
+    # Апдейт считается обработанным, когда бот отправил на него ответ в заглушку Bot API
+    before = _api_calls(args, 'sendMessage')
+    started = time.perf_counter()
+    asyncio.run(_post_updates(url, bodies, args.concurrency))
+    while _api_calls(args, 'sendMessage') < before + len(bodies):
+        if time.perf_counter() - started > deadline:
+            raise RuntimeError("bot did not answer every update in time")
+        time.sleep(0.02)
+    return time.perf_counter() - started
+
+def measure_workers(args, db_path: str, workers: int) -> dict:
+    """Runs `bot.py run` in webhook mode with BOT_WORKERS=workers and replays balance taps through /tg_webhook."""
+    port = args.port + 2
+    env = dict(os.environ, DB_PATH=db_path, BOT_MODE='webhook', BOT_WORKERS=str(workers), WEBHOOK_PORT=str(port),
+               WEBHOOK_HOST=f'http://127.0.0.1:{port}', UPDATE_CONCURRENCY=str(args.concurrency))
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'), 'run'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}/tg_webhook'
+    factory = UpdateFactory()
+    users = list(range(1, args.users + 1))
+    try:
+        if not _poll(url, data=b'{"update_id": 0}'):
+            raise RuntimeError("bot did not start, run it by hand with the same environment to see why")
+        # Прогрев: каждый шард поднял Application и открыл соединения к БД и заглушке
+        _replay_replies(args, url, [json.dumps(factory.message(tg, '💰 Баланс')).encode() for tg in users[:max(64, 8 * workers)]])
+        bodies = [json.dumps(factory.message(random.choice(users), '💰 Баланс')).encode() for _ in range(args.scaling_updates)]
+        seconds = _replay_replies(args, url, bodies)
+        return {'count': len(bodies), 'seconds': seconds, 'throughput': len(bodies) / seconds}
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def run_scaling(args, db_path: str) -> dict:
+    results = {}
+    print(f"{'workers':<12} {'count':>7} {'throughput':>12} {'speedup':>8}")
+    for workers in args.workers:
+        r = measure_workers(args, db_path, workers)
+        results[f'workers_{workers}'] = r
+        base = results[f'workers_{args.workers[0]}']['throughput']
+        print(f"{workers:<12} {r['count']:>7} {r['throughput']:>10.1f}/s {r['throughput'] / base:>7.2f}x")
+    print(f"(cpu cores: {os.cpu_count()}; 0 workers = updates handled in the HTTP process)")
+    return results
+
+# --- Baselines ---
+COMPARED = (('throughput', +1), ('p50_ms', -1), ('p99_ms', -1), ('loop_lag_ms', -1), ('http_ms', -1), ('ready_ms', -1))
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    ok = True
+    print("\ncompared to baseline:")
+    for scenario, current in results.items():
+        base = baseline.get('results', {}).get(scenario)
+        if not base:
+            continue
+        parts = []
+        for key, better in COMPARED:
+            if key not in current or not base.get(key):
+                continue
+            change = 100 * (current[key] - base[key]) / base[key]
+            regressed = -better * change > threshold
+            ok &= not regressed
+            parts.append(f"{key} {change:+.1f}%{' !' if regressed else ''}")
+        print(f"{scenario:<12} " + ', '.join(parts))
+    return ok
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay benchmark for the Metro Shop bot")
+    parser.add_argument('--users', type=int, default=10000, help="existing users seeded before the run")
+    parser.add_argument('--products', type=int, default=40)
+    parser.add_argument('--orders', type=int, default=20000, help="historical orders seeded before the run")
+    parser.add_argument('--new-users', type=int, default=2000, help="synthetic users driven through the funnel")
+    parser.add_argument('--concurrency', type=int, default=64, help="updates in flight at once")
+    parser.add_argument('--lava-latency', type=float, default=0.05, help="stub invoice latency, seconds")
+    parser.add_argument('--tg-latency', type=float, default=0.0, help="fake Bot API latency per call, seconds")
+    parser.add_argument('--tg-rate', type=float, default=100000, help="outbound messages/s allowed by the token buckets")
+    parser.add_argument('--broadcast', action='store_true', help="also broadcast to every seeded and new user")
+    parser.add_argument('--startup', type=int, default=0, metavar='N',
+                        help="time a fresh start (migrations) and N restarts of `bot.py run` in webhook mode")
+    parser.add_argument('--sizes', type=lambda v: [int(x) for x in v.split(',')], metavar='N,N,...',
+                        help="instead of the replay, time hot lookups with N users and N orders, e.g. 10000,100000,1000000")
+    parser.add_argument('--lookups', type=int, default=2000, help="lookups per query and size with --sizes")
+    parser.add_argument('--workers', type=lambda v: [int(x) for x in v.split(',')], metavar='N,N,...',
+                        help="instead of the replay, run `bot.py run` in webhook mode with BOT_WORKERS=N for each N "
+                             "and measure updates/s through /tg_webhook, e.g. 0,1,2,4")
+    parser.add_argument('--scaling-updates', type=int, default=5000, help="updates per run with --workers")
+    parser.add_argument('--import-items', type=int, metavar='N',
+                        help="instead of the replay, time `import-catalog` of N items (first, unchanged and 10%% changed)")
+    parser.add_argument('--legacy-db', action='store_true',
+                        help="run with the original connect-per-query DB access (the 'before' of the pooled layer)")
+    parser.add_argument('--port', type=int, default=18700, help="fake API port; webhook server uses port + 1")
+    parser.add_argument('--db', help="database path (default: fresh temp file)")
+    parser.add_argument('--baseline', help="compare against a baseline JSON written by --save-baseline")
+    parser.add_argument('--save-baseline', help="write this run's results as a baseline")
+    parser.add_argument('--fail-on-regression', type=float, metavar='PCT',
+                        help="exit 1 if throughput or latency is worse than the baseline by more than PCT%%")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({
+        'DB_PATH': args.db or os.path.join(workdir, 'bench.db'),
+        'TG_BOT_TOKEN': '1:bench', 'TG_API_URL': f'http://127.0.0.1:{args.port}/bot',
+        'LAVA_API_URL': f'http://127.0.0.1:{args.port}', 'LAVA_PROJECT_ID': 'bench',
+        'WEBHOOK_HOST': f'http://127.0.0.1:{args.port + 1}', 'OUTBOX_MAX_SIZE': '1000000',
+        'BROADCAST_RATE': str(args.tg_rate),
+    })
+    fake = multiprocessing.get_context('spawn').Process(target=run_fake_api, args=(args.port, args.lava_latency, args.tg_latency), daemon=True)
+    fake.start()
+    # Конфиг bot.py читается при импорте, поэтому импортируем после настройки окружения
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.WARNING)
+    bot = importlib.import_module('bot')
+    try:
+        if args.sizes:
+            results = run_sizes(bot, args, workdir)
+        elif args.import_items:
+            results = run_import(bot, args, workdir)
+        elif args.workers:
+            seed(bot, args.users, args.products, args.orders)
+            bot.close_db()
+            time.sleep(0.5)  # даём заглушке подняться
+            results = run_scaling(args, os.environ['DB_PATH'])
+        else:
+            started = time.perf_counter()
+            seed(bot, args.users, args.products, args.orders)
+            print(f"seeded {args.users} users, {args.products} products, {args.orders} orders in {time.perf_counter() - started:.2f}s")
+            time.sleep(0.5)  # даём заглушке подняться
+            results = run_startup(args, workdir) if args.startup else {}
+            if args.legacy_db:
+                install_legacy_db(bot)
+            if args.new_users:
+                results.update(asyncio.run(bench(bot, args)))
+    finally:
+        bot.close_db()
+        fake.terminate()
+
+    meta = {k: v for k, v in vars(args).items() if k not in ('baseline', 'save_baseline', 'fail_on_regression', 'db', 'legacy_db')}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': datetime.utcnow().isoformat(), 'args': meta, 'results': results}, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('args') != meta:
+            print("warning: baseline was recorded with different arguments")
+        if not compare(results, baseline, args.fail_on_regression or float('inf')) and args.fail_on_regression is not None:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,11 +12,25 @@ import os
 import sqlite3
 import logging
 import json
+import multiprocessing
 import hmac
 import hashlib
+import argparse
 import asyncio
-from datetime import datetime
-from typing import List, Optional
+import base64
+import bisect
+import functools
+import io
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 # Сторонние библиотеки (убедитесь, что установлен aiohttp: pip install aiohttp)
 from aiohttp import web
@@ -31,32 +45,108 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
-from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TelegramError
 
 # --- Configuration ---
+CONFIG_ERRORS: List[str] = []  # ошибки разбора переменных окружения; сообщает validate_config
+
+def _env_number(name: str, default: str, cast=int):
+    # Кривое значение не роняет импорт: берём значение по умолчанию, ошибку покажет validate_config
+    raw = os.getenv(name, default)
+    try:
+        return cast(raw)
+    except ValueError:
+        CONFIG_ERRORS.append(f"{name}: ожидается {'целое число' if cast is int else 'число'}, получено {raw!r}")
+        return cast(default)
+
 TG_BOT_TOKEN = os.getenv('TG_BOT_TOKEN', '8269807126:AAFLKT39qdkKR81df5nEYuCFIk3z8kdZbSo')
-OWNER_ID = int(os.getenv('OWNER_ID', '8473513085'))
-ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', '-1003448809517'))
+OWNER_ID = _env_number('OWNER_ID', '8473513085')
+ADMIN_CHAT_ID = _env_number('ADMIN_CHAT_ID', '-1003448809517')
 DB_PATH = os.getenv('DB_PATH', 'metro_shop.db')
+DB_POOL_SIZE = _env_number('DB_POOL_SIZE', '4')
 SUPPORT_CONTACT_USER = os.getenv('SUPPORT_CONTACT', '@Wixyeez')
 
 # --- LAVA.TOP CONFIG ---
 LAVA_SECRET_KEY = os.getenv('LAVA_SECRET_KEY', '5xRSR1dnermm7LYtMRICZclNxuEAteScAKXuWSuOdebuZvUoPnOTu12DgKYrcVvI')
 LAVA_PROJECT_ID = os.getenv('LAVA_PROJECT_ID', 'YOUR_LAVA_PROJECT_ID_HERE')
 WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', 'http://YOUR_SERVER_IP:8080')
-WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PORT = _env_number('WEBHOOK_PORT', '8080')
+
+# --- Deployment mode ---
+BOT_MODE = os.getenv('BOT_MODE', 'polling')          # polling (разработка) | webhook
+BOT_WORKERS = _env_number('BOT_WORKERS', '0')     # процессов-обработчиков апдейтов в режиме webhook; 0 — в основном процессе
+WORKER_RESTART_BACKOFF = 5   # секунд между перезапусками упавшего процесса-обработчика
+TG_WEBHOOK_PATH = '/tg_webhook'
+TG_WEBHOOK_SECRET = os.getenv('TG_WEBHOOK_SECRET', '')
+UPDATE_CONCURRENCY = _env_number('UPDATE_CONCURRENCY', '64')  # апдейтов разных чатов одновременно
+HANDLER_TIMEOUT = _env_number('HANDLER_TIMEOUT', '60', float)      # секунд на обработку одного апдейта
+TG_API_URL = os.getenv('TG_API_URL', 'https://api.telegram.org/bot')  # свой Bot API сервер / заглушка
+LAVA_API_URL = os.getenv('LAVA_API_URL', 'https://api.lava.ru')
+LAVA_CONNECT_TIMEOUT = _env_number('LAVA_CONNECT_TIMEOUT', '5', float)
+LAVA_READ_TIMEOUT = _env_number('LAVA_READ_TIMEOUT', '15', float)
+LAVA_MAX_CONCURRENCY = _env_number('LAVA_MAX_CONCURRENCY', '20')
+LAVA_RETRIES = 2
+LAVA_BREAKER_THRESHOLD = 5   # ошибок подряд до размыкания
+LAVA_BREAKER_COOLDOWN = 30   # секунд до пробного запроса
+
+# --- CLOUDTIPS CONFIG ---
+CLOUDTIPS_SECRET = os.getenv('CLOUDTIPS_SECRET', '')
 
 # --- Logic Config ---
 ADMIN_IDS: List[int] = [OWNER_ID]
 MAX_WORKERS_PER_ORDER = 3
 WORKER_PERCENT = 0.7
 REFERRAL_PERCENT = 0.10  # 10%
+ORDER_PAYMENT_TTL = _env_number('ORDER_PAYMENT_TTL', '1800')  # секунд на оплату заказа (и резерв промокода)
+SWEEP_INTERVAL = 60          # секунд между проходами фоновой очистки
+SWEEP_BATCH = 500            # строк за одну транзакцию очистки
+INBOX_BATCH = 100            # событий вебхуков за один проход обработчика
+INBOX_POLL_INTERVAL = 5      # секунд; страховочный опрос inbox без сигнала
+INBOX_MAX_ATTEMPTS = 10
+INBOX_RETRY_BASE = 5         # секунд до повтора упавшего события; удваивается с каждой попыткой
+INBOX_RETRY_MAX = 900        # потолок паузы между повторами
+SETTLE_INTERVAL = 300        # секунд между расчётами выплат исполнителям
+SETTLE_BATCH = 200           # заказов на одну транзакцию расчёта
+
+# --- Admin reports ---
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')   # Bearer-токен для /admin/*; пусто — эндпоинты выключены
+ADMIN_PAGE_SIZE = 20
+ADMIN_MAX_PAGE_SIZE = 200
+
+# --- Metrics / profiling ---
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # секунд
+WORKER_METRICS_PORT = _env_number('WORKER_METRICS_PORT', '0')  # воркер N отдаёт /metrics на порту +N; 0 — выкл.
+PROFILE_INTERVAL = 0.005     # секунд между снимками стека
+PROFILE_MAX_SECONDS = 300
+
+# --- Telegram limits (outbound queue) ---
+TG_GLOBAL_RATE = 25          # сообщений в секунду на весь бот
+TG_PRIVATE_INTERVAL = 1.0    # секунд между сообщениями в один личный чат
+TG_GROUP_INTERVAL = 3.0      # секунд между сообщениями в одну группу (20/мин)
+OUTBOX_MAX_SIZE = _env_number('OUTBOX_MAX_SIZE', '5000')
+OUTBOX_RETRIES = 3
+BROADCAST_RATE = _env_number('BROADCAST_RATE', '15', float)  # сообщений в секунду на рассылку (из общего лимита)
+BROADCAST_SENDERS = 16       # параллельных отправок внутри рассылки
+BROADCAST_CHUNK = 500        # получателей между контрольными точками
+BROADCAST_REPORT_INTERVAL = 60  # секунд между отчётами о ходе рассылки
+BROADCAST_POLL_INTERVAL = 30    # секунд; опрос новых рассылок без сигнала
+
+# --- Catalog ---
+CATALOG_PAGE_SIZE = 8        # товаров на страницу (<= 10, лимит альбома)
+CATALOG_IMPORT_BATCH = 1000  # строк на транзакцию при импорте
+
+# --- User cache ---
+USER_CACHE_SIZE = _env_number('USER_CACHE_SIZE', '50000')
+USER_CACHE_TTL = 300         # секунд
+PUBG_ID_LENGTH = (5, 12)     # допустимая длина цифрового PUBG ID
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -66,10 +156,13 @@ PRIVACY_POLICY_URL = "https://telegra.ph/Politika-konfidencialnosti-08-15-17"
 USER_AGREEMENT_URL = "https://telegra.ph/Polzovatelskoe-soglashenie-08-15-10"
 
 # --- DB Helper ---
-def init_db() -> None:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+# Миграции схемы: номер применённой версии хранится в PRAGMA user_version.
+# Новые изменения схемы — только новой функцией в конце MIGRATIONS.
+def _add_column(cur: sqlite3.Cursor, table: str, column: str, decl: str) -> None:
+    if column not in {r[1] for r in cur.execute(f'PRAGMA table_info({table})')}:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
+def _migration_1_baseline(cur: sqlite3.Cursor) -> None:
     # Users
     cur.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -82,10 +175,8 @@ def init_db() -> None:
         invited_by INTEGER
     )
     ''')
-    try: cur.execute("ALTER TABLE users ADD COLUMN balance REAL DEFAULT 0")
-    except: pass
-    try: cur.execute("ALTER TABLE users ADD COLUMN invited_by INTEGER")
-    except: pass
+    _add_column(cur, 'users', 'balance', 'REAL DEFAULT 0')
+    _add_column(cur, 'users', 'invited_by', 'INTEGER')
 
     # Products
     cur.execute('''
@@ -124,10 +215,10 @@ def init_db() -> None:
         done_at TEXT
     )
     ''')
-    try: cur.execute("ALTER TABLE orders ADD COLUMN payment_id TEXT")
-    except: pass
-    try: cur.execute("ALTER TABLE orders ADD COLUMN promo_code TEXT")
-    except: pass
+    _add_column(cur, 'orders', 'payment_id', 'TEXT')
+    _add_column(cur, 'orders', 'promo_code', 'TEXT')
+    _add_column(cur, 'orders', 'started_at', 'TEXT')
+    _add_column(cur, 'orders', 'done_at', 'TEXT')
 
     # Promocodes
     cur.execute('''
@@ -177,20 +268,467 @@ def init_db() -> None:
     )
     ''')
 
-    conn.commit()
-    conn.close()
+    # Payments: обработанные события платежей (идемпотентность вебхуков)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS payment_events (
+        event_id TEXT PRIMARY KEY,
+        order_id INTEGER,
+        created_at TEXT
+    )
+    ''')
+
+def _migration_2_indexes(cur: sqlite3.Cursor) -> None:
+    # users.tg_id уже покрыт UNIQUE-индексом, used_promocodes — UNIQUE(user_id, code)
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_invited_by ON users(invited_by)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, id, price, status)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_order_workers_order ON order_workers(order_id, worker_id)')
+
+def _migration_3_product_catalog(cur: sqlite3.Cursor) -> None:
+    # Поля товара из items.json; sku — внешний id товара для импорта/экспорта
+    _add_column(cur, 'products', 'sku', 'TEXT')
+    _add_column(cur, 'products', 'category', 'TEXT')
+    _add_column(cur, 'products', 'old_price', 'REAL')
+    _add_column(cur, 'products', 'stock', 'INTEGER')
+    _add_column(cur, 'products', 'currency', "TEXT DEFAULT 'RUB'")
+    _add_column(cur, 'products', 'delivery_text', 'TEXT')
+    _add_column(cur, 'products', 'extra', 'TEXT')
+    cur.execute("UPDATE products SET sku = 'db_' || id WHERE sku IS NULL")
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products(sku)')
+
+def _migration_4_promo_reservations(cur: sqlite3.Cursor) -> None:
+    # Активация промокода резервируется на время оплаты заказа
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS promo_reservations (
+        order_id INTEGER PRIMARY KEY,
+        code TEXT,
+        user_id INTEGER,
+        expires_at TEXT
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_promo_reservations_expires ON promo_reservations(expires_at)')
+
+def _migration_5_order_workers_unique(cur: sqlite3.Cursor) -> None:
+    # Один исполнитель — одна запись на заказ; дубли из старых версий схлопываем
+    cur.execute('DELETE FROM order_workers WHERE id NOT IN (SELECT MIN(id) FROM order_workers GROUP BY order_id, worker_id)')
+    cur.execute('DROP INDEX IF EXISTS idx_order_workers_order')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_order_workers_unique ON order_workers(order_id, worker_id)')
+
+def _migration_6_webhook_inbox(cur: sqlite3.Cursor) -> None:
+    # Входящие платёжные события: сохраняем до ответа провайдеру, обрабатываем в фоне
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS webhook_inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT,
+        event_id TEXT UNIQUE,
+        order_id INTEGER,
+        payload BLOB,
+        received_at TEXT,
+        processed_at TEXT,
+        attempts INTEGER DEFAULT 0,
+        error TEXT
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_webhook_inbox_pending ON webhook_inbox(id) WHERE processed_at IS NULL')
+
+def _migration_7_order_lifecycle(cur: sqlite3.Cursor) -> None:
+    # Отдельная отметка времени на каждый статус; created_at больше не перезаписывается при оплате
+    _add_column(cur, 'orders', 'paid_at', 'TEXT')
+    _add_column(cur, 'orders', 'expired_at', 'TEXT')
+    _add_column(cur, 'orders', 'refunded_at', 'TEXT')
+    cur.execute("UPDATE orders SET paid_at = created_at WHERE paid_at IS NULL AND status IN ('paid', 'in_progress', 'done')")
+    # Частичный индекс: очистка смотрит только на неоплаченные заказы, сколько бы ни было остальных
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders(created_at) WHERE status='pending_payment'")
+    cur.execute('DROP INDEX IF EXISTS idx_promo_reservations_expires')
+
+def _migration_8_worker_ledger(cur: sqlite3.Cursor) -> None:
+    # Выплаты идемпотентны по (заказ, исполнитель); итоги по исполнителям ведутся инкрементально
+    _add_column(cur, 'orders', 'settled_at', 'TEXT')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_unsettled ON orders(id) WHERE status='done' AND settled_at IS NULL")
+    cur.execute('DELETE FROM worker_payouts WHERE id NOT IN (SELECT MIN(id) FROM worker_payouts GROUP BY order_id, worker_id)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_worker_payouts_unique ON worker_payouts(order_id, worker_id)')
+    cur.execute('DELETE FROM reviews WHERE id NOT IN (SELECT MIN(id) FROM reviews GROUP BY order_id, worker_id)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_reviews_unique ON reviews(order_id, worker_id)')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS worker_stats (
+        worker_id INTEGER PRIMARY KEY,
+        worker_username TEXT,
+        orders_count INTEGER DEFAULT 0,
+        total_earned REAL DEFAULT 0,
+        rating_sum INTEGER DEFAULT 0,
+        rating_count INTEGER DEFAULT 0,
+        updated_at TEXT
+    )
+    ''')
+    cur.execute('''
+    INSERT OR IGNORE INTO worker_stats (worker_id, orders_count, total_earned, rating_sum, rating_count, updated_at)
+    SELECT w.worker_id,
+           (SELECT COUNT(*) FROM worker_payouts p WHERE p.worker_id = w.worker_id),
+           (SELECT COALESCE(SUM(amount), 0) FROM worker_payouts p WHERE p.worker_id = w.worker_id),
+           (SELECT COALESCE(SUM(rating), 0) FROM reviews r WHERE r.worker_id = w.worker_id),
+           (SELECT COUNT(*) FROM reviews r WHERE r.worker_id = w.worker_id),
+           datetime('now')
+    FROM (SELECT worker_id FROM worker_payouts UNION SELECT worker_id FROM reviews) w
+    ''')
+    # Заказы, выполненные до появления расчётов: выплаты по ним уже делались вручную
+    cur.execute("UPDATE orders SET settled_at = datetime('now') WHERE status='done' AND settled_at IS NULL")
+
+def _migration_9_reporting(cur: sqlite3.Cursor) -> None:
+    # Дневные агрегаты для отчётов ведутся в тех же транзакциях, что и сами события
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER DEFAULT 0,
+        referred_users INTEGER DEFAULT 0,
+        orders_paid INTEGER DEFAULT 0,
+        revenue REAL DEFAULT 0,
+        referral_bonus REAL DEFAULT 0,
+        promo_orders INTEGER DEFAULT 0,
+        refunds INTEGER DEFAULT 0,
+        refunded_amount REAL DEFAULT 0
+    )
+    ''')
+    cur.execute('''
+    INSERT OR IGNORE INTO daily_stats (day) SELECT DISTINCT substr(registered_at, 1, 10) FROM users WHERE registered_at IS NOT NULL
+    UNION SELECT DISTINCT substr(paid_at, 1, 10) FROM orders WHERE paid_at IS NOT NULL
+    ''')
+    cur.execute('''
+    UPDATE daily_stats SET
+        new_users = (SELECT COUNT(*) FROM users WHERE substr(registered_at, 1, 10) = day),
+        referred_users = (SELECT COUNT(*) FROM users WHERE substr(registered_at, 1, 10) = day AND invited_by IS NOT NULL),
+        orders_paid = (SELECT COUNT(*) FROM orders WHERE substr(paid_at, 1, 10) = day),
+        revenue = (SELECT COALESCE(SUM(price), 0) FROM orders WHERE substr(paid_at, 1, 10) = day),
+        promo_orders = (SELECT COUNT(*) FROM orders WHERE substr(paid_at, 1, 10) = day AND promo_code IS NOT NULL)
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_id ON orders(status, id)')
+
+def _migration_10_broadcasts(cur: sqlite3.Cursor) -> None:
+    # Рассылка продолжается с last_user_id после рестарта; заблокировавшие бота исключаются
+    _add_column(cur, 'users', 'blocked_at', 'TEXT')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'running',
+        created_by INTEGER,
+        created_at TEXT,
+        finished_at TEXT,
+        total INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0
+    )
+    ''')
 
-def db_execute(query: str, params: tuple = (), fetch: bool = False):
-    conn = sqlite3.connect(DB_PATH)
+def _migration_11_payment_amount(cur: sqlite3.Cursor) -> None:
+    # Сумма из вебхука: заказ помечается оплаченным, только если заплачено не меньше цены
+    _add_column(cur, 'webhook_inbox', 'amount', 'REAL')
+
+def _migration_12_legacy_order_states(cur: sqlite3.Cursor) -> None:
+    # Статусы ручной оплаты по скриншоту: из них не ведёт ни один переход, заказы висели бы вечно.
+    # Скриншоты не удаляются (payment_screenshot_file_id), спорные заказы админ находит в /admin/orders?status=expired
+    legacy = cur.execute("SELECT COUNT(*) FROM orders WHERE status IN ('awaiting_screenshot', 'pending_verification')").fetchone()[0]
+    if legacy:
+        cur.execute("UPDATE orders SET status='expired', expired_at=? WHERE status IN ('awaiting_screenshot', 'pending_verification')",
+                    (now_iso(),))
+        logger.warning(f"{legacy} orders in legacy screenshot states marked expired")
+
+def _migration_13_inbox_backoff(cur: sqlite3.Cursor) -> None:
+    # Упавшее событие повторяется не раньше next_attempt_at, а не на следующем же проходе
+    _add_column(cur, 'webhook_inbox', 'next_attempt_at', 'TEXT')
+
+def _migration_14_catalog_version(cur: sqlite3.Cursor) -> None:
+    # Счётчик правок products: импорт из CLI (другой процесс) сразу виден кэшу каталога работающего бота.
+    # Увеличивается в той же транзакции, что пишет в products (построчный триггер замедлял импорт в полтора раза)
+    cur.execute('CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL)')
+    if cur.execute('SELECT COUNT(*) FROM catalog_version').fetchone()[0] == 0:
+        cur.execute('INSERT INTO catalog_version (version) VALUES (0)')
+
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _migration_1_baseline,
+    _migration_2_indexes,
+    _migration_3_product_catalog,
+    _migration_4_promo_reservations,
+    _migration_5_order_workers_unique,
+    _migration_6_webhook_inbox,
+    _migration_7_order_lifecycle,
+    _migration_8_worker_ledger,
+    _migration_9_reporting,
+    _migration_10_broadcasts,
+    _migration_11_payment_amount,
+    _migration_12_legacy_order_states,
+    _migration_13_inbox_backoff,
+    _migration_14_catalog_version,
+]
+
+def init_db() -> None:
+    # Второй экземпляр ждёт, пока первый закончит миграцию, а не падает с database is locked
+    conn = sqlite3.connect(DB_PATH, timeout=60, isolation_level=None)
     cur = conn.cursor()
-    cur.execute(query, params)
-    data = None
-    if fetch:
-        data = cur.fetchall()
-    else:
-        conn.commit()
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(MIGRATIONS):
+        # Быстрый путь при рестарте: схема актуальна, DDL не трогаем
+        if version > len(MIGRATIONS):
+            logger.warning(f"DB schema version {version} is newer than this code ({len(MIGRATIONS)})")
+        conn.close()
+        return
+    for number, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur.execute('BEGIN IMMEDIATE')
+        # Версию перечитываем под блокировкой: параллельно стартовавший экземпляр мог уже применить эту миграцию,
+        # и повторный прогон (например, _migration_8_worker_ledger) испортил бы данные, а версия откатилась бы назад
+        if cur.execute('PRAGMA user_version').fetchone()[0] >= number:
+            cur.execute('COMMIT')
+            continue
+        try:
+            migrate(cur)
+            cur.execute(f'PRAGMA user_version = {number}')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+        logger.info(f"DB migrated to schema version {number}")
+    cur.execute('ANALYZE')
     conn.close()
-    return data
+
+
+# --- Metrics ---
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    """Prometheus-style counters and latency histograms, plus collectors for existing stats dicts."""
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], list] = {}
+        self._collectors: List[Callable[[], list]] = []
+        # Наблюдения приходят и из потоков пула БД
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[bisect.bisect_left(self.buckets, seconds)] += 1
+            h[-1] += seconds
+
+    def add_collector(self, fn: Callable[[], list]) -> None:
+        """fn() -> [(name, labels dict, value)]; names ending in _total are exported as counters."""
+        self._collectors.append(fn)
+
+    def histogram(self, name: str) -> Dict[tuple, list]:
+        with self._lock:
+            return {labels: list(h) for (n, labels), h in self._histograms.items() if n == name}
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, list(h)) for k, h in self._histograms.items())
+        for fn in self._collectors:
+            try:
+                samples = fn()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+                continue
+            counters += [((name, tuple(sorted(labels.items()))), value) for name, labels, value in samples]
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{name}{_label_str(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), h):
+                total += count
+                lines.append(f"{name}_bucket{_label_str(labels + (('le', bound),))} {total}")
+            lines.append(f"{name}_sum{_label_str(labels)} {h[-1]}")
+            lines.append(f"{name}_count{_label_str(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@functools.lru_cache(maxsize=1024)
+def query_shape(query: str) -> str:
+    # Запросы параметризованы, так что текст SQL и есть «форма» запроса
+    return ' '.join(query.split())[:120]
+
+async def call_handler(handler: Callable, update, context, *args):
+    name = handler.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(update, context, *args)
+    except Exception:
+        metrics.inc('bot_handler_errors_total', handler=name)
+        raise
+    finally:
+        metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+
+def instrumented(handler: Callable) -> Callable:
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        return await call_handler(handler, update, context)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and status of every Bot API call by method."""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.inc('telegram_api_requests_total', method=endpoint, code='error')
+            raise
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started, method=endpoint)
+        metrics.inc('telegram_api_requests_total', method=endpoint, code=str(code))
+        return code, payload
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a helper thread; results in folded-stack format."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        self.samples = {}
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.samples
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    @staticmethod
+    def summary(samples: Dict[str, int], top: int = 15) -> str:
+        total = sum(samples.values())
+        if not total:
+            return "Нет сэмплов."
+        own: Dict[str, int] = {}
+        for stack, count in samples.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            own[leaf] = own.get(leaf, 0) + count
+        lines = [f"🔬 {total} сэмплов, топ по собственному времени:"]
+        for leaf, count in sorted(own.items(), key=lambda kv: -kv[1])[:top]:
+            lines.append(f"{100 * count / total:5.1f}% {leaf}")
+        return "\n".join(lines)
+
+profiler = SamplingProfiler()
+
+# --- DB Pool ---
+# Долгоживущие соединения (по одному на поток пула), запросы выполняются вне event loop.
+_db_local = threading.local()
+_db_connections: List[sqlite3.Connection] = []
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+def _db_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None,
+                           check_same_thread=False, cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+    conn.execute('PRAGMA mmap_size=134217728')
+    return conn
+
+def _db_conn() -> sqlite3.Connection:
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = _db_connect()
+        _db_connections.append(conn)
+    return conn
+
+def _db_get_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+    return _db_executor
+
+def _db_execute_sync(query: str, params: tuple = (), fetch: bool = False):
+    started = time.perf_counter()
+    try:
+        cur = _db_conn().execute(query, params)
+        return cur.fetchall() if fetch else None
+    finally:
+        metrics.observe('db_query_seconds', time.perf_counter() - started, query=query_shape(query))
+
+def _db_transaction_sync(fn: Callable[..., Any], *args):
+    conn = _db_conn()
+    started = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = fn(conn, *args)
+        conn.execute('COMMIT')
+    except BaseException:
+        # COMMIT тоже может упасть (BUSY, FULL, отложенные FK) — соединение не должно остаться в транзакции
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    metrics.observe('db_transaction_seconds', time.perf_counter() - started, fn=fn.__name__)
+    return result
+
+async def db_execute(query: str, params: tuple = (), fetch: bool = False):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_get_executor(), _db_execute_sync, query, params, fetch)
+
+async def db_transaction(fn: Callable[..., Any], *args):
+    """Runs fn(conn, *args) inside BEGIN IMMEDIATE ... COMMIT on a pool thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_get_executor(), _db_transaction_sync, fn, *args)
+
+def close_db() -> None:
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+    while _db_connections:
+        conn = _db_connections.pop()
+        try:
+            # Статистика планировщика обновляется по накопленным за жизнь соединения запросам
+            conn.execute('PRAGMA optimize')
+        except sqlite3.Error:
+            pass
+        conn.close()
 
 def now_iso() -> str:
     return datetime.utcnow().isoformat()
@@ -198,106 +736,969 @@ def now_iso() -> str:
 def is_admin_tg(tg_id: int) -> bool:
     return tg_id in ADMIN_IDS
 
+# --- Outbound messages ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class OutboundQueue:
+    """Bounded per-chat queues drained under Telegram's per-chat and global limits."""
+
+    def __init__(self, bot, maxsize: int = OUTBOX_MAX_SIZE):
+        self.bot = bot
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(TG_GLOBAL_RATE)
+        self.pending = 0
+        self._chats: Dict[int, Deque[Tuple[str, dict]]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._next_slot: Dict[int, float] = {}
+        self._migrated: Dict[int, int] = {}
+
+    def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        chat_id = self._migrated.get(chat_id, chat_id)
+        if self.pending >= self.maxsize:
+            logger.warning(f"Outbox full, dropping message to {chat_id}")
+            return False
+        self._chats.setdefault(chat_id, deque()).append((text, kwargs))
+        self.pending += 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return True
+
+    async def _drain(self, chat_id: int) -> None:
+        q = self._chats[chat_id]
+        try:
+            while q:
+                text, kwargs = q.popleft()
+                self.pending -= 1
+                # Склеиваем подряд идущие простые тексты в одно сообщение
+                while not kwargs and q and not q[0][1] and len(text) + len(q[0][0]) + 2 <= 4096:
+                    text += '\n\n' + q.popleft()[0]
+                    self.pending -= 1
+                await self._wait_chat_slot(chat_id)
+                try:
+                    await self._deliver(chat_id, text, kwargs)
+                except Exception as e:
+                    logger.error(f"Outbox: failed to deliver to {chat_id}: {e}")
+        finally:
+            # При отмене недоставленный остаток очереди снимается со счётчика
+            self.pending -= len(q)
+            self._chats.pop(chat_id, None)
+            self._tasks.pop(chat_id, None)
+            if len(self._next_slot) > 1024:
+                now = time.monotonic()
+                self._next_slot = {c: t for c, t in self._next_slot.items() if t > now or c in self._tasks}
+
+    async def _wait_chat_slot(self, chat_id: int) -> None:
+        now = time.monotonic()
+        slot = self._next_slot.get(chat_id, now)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        interval = TG_GROUP_INTERVAL if chat_id < 0 else TG_PRIVATE_INTERVAL
+        self._next_slot[chat_id] = max(slot, now) + interval
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict) -> None:
+        chat_id = self._migrated.get(chat_id, chat_id)
+        for attempt in range(OUTBOX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if hasattr(delay, 'total_seconds') else delay)
+            except ChatMigrated as e:
+                # Группа стала супергруппой: шлём по новому id (ADMIN_CHAT_ID стоит обновить)
+                logger.warning(f"Outbox: chat {chat_id} migrated to {e.new_chat_id}")
+                self._migrated[chat_id] = chat_id = e.new_chat_id
+            except (Forbidden, BadRequest) as e:
+                logger.warning(f"Outbox: message to {chat_id} rejected: {e}")
+                return
+            except NetworkError as e:
+                logger.warning(f"Outbox: network error for {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.warning(f"Outbox: message to {chat_id} failed: {e}")
+                return
+        logger.error(f"Outbox: giving up on message to {chat_id}")
+
+    async def close(self, timeout: float = 10) -> None:
+        tasks = list(self._tasks.values())
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+outbox: Optional[OutboundQueue] = None
+metrics.add_collector(lambda: [('outbox_pending', {}, outbox.pending if isinstance(outbox, OutboundQueue) else 0),
+                               ('outbox_chats', {}, len(outbox._chats) if isinstance(outbox, OutboundQueue) else 0)])
+
+def notify(chat_id: int, text: str, **kwargs) -> None:
+    if outbox is None:
+        logger.warning(f"Outbox is not running, message to {chat_id} dropped")
+        return
+    outbox.send(chat_id, text, **kwargs)
+
+# --- Catalog cache ---
+class CatalogCache:
+    """In-process snapshot of products, reloaded when catalog_version changes (bumped by every write to products)."""
+
+    def __init__(self):
+        self.version = 0
+        self._items: Optional[List[tuple]] = None
+        self._by_id: Dict[int, tuple] = {}
+        self._db_version: Optional[int] = None
+
+    async def items(self) -> List[tuple]:
+        # Одна строка по rowid на каждое обращение: цена в buy_callback не отстаёт от импорта из другого процесса
+        db_version = (await db_execute('SELECT version FROM catalog_version', fetch=True))[0][0]
+        if self._items is not None and db_version == self._db_version:
+            return self._items
+        version = self.version
+        rows = await db_execute('SELECT id, name, price, photo FROM products ORDER BY id', fetch=True)
+        if version == self.version:
+            self._items, self._by_id, self._db_version = rows, {r[0]: r for r in rows}, db_version
+        return rows
+
+    async def get(self, product_id: int) -> Optional[tuple]:
+        await self.items()
+        return self._by_id.get(product_id)
+
+    def invalidate(self) -> None:
+        self.version += 1
+        self._items = None
+
+catalog = CatalogCache()
+
+# --- User cache ---
+class UserCache:
+    """Bounded LRU/TTL cache of user profiles keyed by tg_id (write-through by callers)."""
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+
+    def get(self, tg_id: int) -> Optional[dict]:
+        entry = self._data.get(tg_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self._data.move_to_end(tg_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, tg_id: int, profile: dict) -> None:
+        self._data[tg_id] = (time.monotonic(), profile)
+        self._data.move_to_end(tg_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, tg_id: int, **fields) -> None:
+        entry = self._data.get(tg_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def add(self, tg_id: int, field: str, delta: float) -> None:
+        entry = self._data.get(tg_id)
+        if entry is not None:
+            entry[1][field] += delta
+
+    def invalidate(self, tg_id: int) -> None:
+        self._data.pop(tg_id, None)
+
+user_cache = UserCache()
+metrics.add_collector(lambda: [('user_cache_hits_total', {}, user_cache.hits), ('user_cache_misses_total', {}, user_cache.misses),
+                               ('user_cache_size', {}, len(user_cache._data))])
+
+async def get_user_profile(tg_id: int) -> Optional[dict]:
+    profile = user_cache.get(tg_id)
+    if profile is None:
+        row = await db_execute('SELECT id, pubg_id, balance, (SELECT COUNT(*) FROM users r WHERE r.invited_by = u.tg_id) '
+                               'FROM users u WHERE tg_id=?', (tg_id,), fetch=True)
+        if not row:
+            return None
+        uid, pubg_id, balance, ref_count = row[0]
+        profile = {'id': uid, 'pubg_id': pubg_id, 'balance': balance or 0.0, 'ref_count': ref_count}
+        user_cache.put(tg_id, profile)
+    return profile
+
+# --- Catalog import/export (items.json / JSONL) ---
+PRODUCT_SYNC_COLUMNS = ('name', 'description', 'price', 'photo', 'category', 'old_price',
+                        'stock', 'currency', 'delivery_text', 'extra')
+
+def _iter_json_array(f, chunk_size: int = 1 << 16):
+    # Потоковое чтение JSON-массива: в памяти только текущий элемент и буфер
+    decoder = json.JSONDecoder()
+    buf, eof, opened = '', False, False
+    while True:
+        buf = buf.lstrip()
+        if not opened and buf:
+            if not buf.startswith('['):
+                raise ValueError("expected a JSON array of items")
+            buf, opened = buf[1:], True
+            continue
+        if opened and buf.startswith(','):
+            buf = buf[1:]
+            continue
+        if opened and buf.startswith(']'):
+            return
+        if buf:
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof: raise
+            else:
+                yield obj
+                buf = buf[end:]
+                continue
+        if eof:
+            raise ValueError("unexpected end of catalog file")
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
+def iter_catalog_file(path: str):
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f)
+
+def _opt(value, cast):
+    return None if value is None or value == '' else cast(value)
+
+def _product_row(item: dict) -> tuple:
+    # Приводим к тем типам, в которых поля вернутся из БД, иначе "5" != 5 и товар "обновляется" при каждом импорте
+    return (
+        str(item['name']),
+        _opt(item.get('desc', item.get('description')), str),
+        float(item['price']),
+        _opt(item.get('photo_file_id', item.get('photo')), str),
+        _opt(item.get('category'), str),
+        _opt(item.get('old_price'), float),
+        _opt(item.get('stock'), lambda v: int(float(v))),
+        str(item.get('currency') or 'RUB'),
+        _opt(item.get('delivery_text'), str),
+        json.dumps(item.get('extra') or {}, ensure_ascii=False, sort_keys=True),
+    )
+
+def import_catalog(path: str) -> Dict[str, int]:
+    conn = _db_connect()
+    cols = ', '.join(PRODUCT_SYNC_COLUMNS)
+    existing = {r[0]: tuple(r[1:]) for r in conn.execute(f'SELECT sku, {cols} FROM products')}
+    upsert = (f"INSERT INTO products (sku, {cols}, created_at) VALUES ({', '.join('?' * (len(PRODUCT_SYNC_COLUMNS) + 2))}) "
+              f"ON CONFLICT(sku) DO UPDATE SET " + ', '.join(f'{c}=excluded.{c}' for c in PRODUCT_SYNC_COLUMNS))
+    stats = {'total': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+    batch: List[tuple] = []
+
+    def flush():
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(upsert, batch)
+        conn.execute('UPDATE catalog_version SET version = version + 1')
+        conn.execute('COMMIT')
+        batch.clear()
+
+    created = now_iso()
+    for item in iter_catalog_file(path):
+        stats['total'] += 1
+        sku = str(item['id'])
+        row = _product_row(item)
+        old = existing.get(sku)
+        if old == row:
+            stats['unchanged'] += 1
+            continue
+        stats['updated' if old is not None else 'inserted'] += 1
+        batch.append((sku, *row, created))
+        if len(batch) >= CATALOG_IMPORT_BATCH:
+            flush()
+    if batch:
+        flush()
+    conn.close()
+    return stats
+
+def export_catalog(path: str) -> int:
+    conn = _db_connect()
+    count = 0
+    jsonl = path.endswith('.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        if not jsonl: f.write('[\n')
+        for row in conn.execute(f"SELECT sku, {', '.join(PRODUCT_SYNC_COLUMNS)} FROM products ORDER BY id"):
+            sku, name, desc, price, photo, category, old_price, stock, currency, delivery_text, extra = row
+            item = {
+                "id": sku, "name": name, "price": price, "currency": currency, "old_price": old_price,
+                "desc": desc, "category": category, "photo_file_id": photo, "stock": stock,
+                "delivery_text": delivery_text, "extra": json.loads(extra) if extra else {},
+            }
+            if jsonl:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            else:
+                f.write((',\n' if count else '') + json.dumps(item, ensure_ascii=False, indent=2))
+            count += 1
+        if not jsonl: f.write('\n]\n')
+    conn.close()
+    return count
+
 # --- LAVA PAYMENT LOGIC ---
+class LavaError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # half-open: пропускаем один пробный запрос, остальные ждут следующего окна
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+LAVA_RETRYABLE_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+class LavaClient:
+    """Long-lived HTTP client for api.lava.ru (keep-alive pool, timeouts, retries, breaker)."""
+
+    def __init__(self, base_url: str = LAVA_API_URL):
+        self.base_url = base_url.rstrip('/')
+        self.breaker = CircuitBreaker(LAVA_BREAKER_THRESHOLD, LAVA_BREAKER_COOLDOWN)
+        self.stats = {'requests': 0, 'errors': 0, 'rejected': 0, 'latency_sum': 0.0, 'latency_max': 0.0}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._sem = asyncio.Semaphore(LAVA_MAX_CONCURRENCY)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=LAVA_MAX_CONCURRENCY, keepalive_timeout=60, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=LAVA_CONNECT_TIMEOUT, sock_read=LAVA_READ_TIMEOUT),
+            )
+        return self._session
+
+    async def _post_once(self, path: str, body: bytes, headers: dict) -> dict:
+        started = time.monotonic()
+        self.stats['requests'] += 1
+        try:
+            async with self._sem:
+                async with self._get_session().post(self.base_url + path, data=body, headers=headers) as resp:
+                    if resp.status >= 500:
+                        raise LavaError(f"HTTP {resp.status}")
+                    return await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, LavaError, ValueError):
+            self.stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.stats['latency_sum'] += elapsed
+            self.stats['latency_max'] = max(self.stats['latency_max'], elapsed)
+            metrics.observe('lava_request_seconds', elapsed, path=path)
+
+    async def post(self, path: str, data: dict) -> dict:
+        if not self.breaker.allow():
+            self.stats['rejected'] += 1
+            raise LavaError("circuit open")
+        body = json.dumps(data).encode('utf-8')
+        signature = hmac.new(LAVA_SECRET_KEY.encode('utf-8'), msg=body, digestmod=hashlib.sha256).hexdigest()
+        headers = {"Signature": signature, "Content-Type": "application/json"}
+        for attempt in range(LAVA_RETRIES + 1):
+            try:
+                result = await self._post_once(path, body, headers)
+                self.breaker.success()
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError, LavaError, ValueError) as e:
+                self.breaker.failure()
+                # invoice/create не идемпотентен: повторяем, только если запрос точно не ушёл (не удалось соединиться)
+                retryable = isinstance(e, LAVA_RETRYABLE_ERRORS)
+                if not retryable or attempt == LAVA_RETRIES or not self.breaker.allow():
+                    raise LavaError(str(e) or type(e).__name__) from e
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+lava = LavaClient()
+metrics.add_collector(lambda: [(f'lava_{k}_total' if k in ('requests', 'errors', 'rejected') else f'lava_{k}_seconds', {}, v)
+                               for k, v in lava.stats.items()] + [('lava_breaker_open', {}, int(lava.breaker.opened_at is not None))])
+
 async def create_lava_invoice(order_id: int, amount: float):
-    url = "https://api.lava.ru/business/invoice/create"
-    
     data = {
         "sum": float(amount),
         "orderId": str(order_id),
         "shopId": LAVA_PROJECT_ID,
         "hookUrl": f"{WEBHOOK_HOST}/lava_webhook",
+        "expire": max(1, ORDER_PAYMENT_TTL // 60),
         "comment": f"Order {order_id}"
     }
-    
-    json_str = json.dumps(data)
-    signature = hmac.new(
-        bytes(LAVA_SECRET_KEY, 'utf-8'),
-        msg=bytes(json_str, 'utf-8'),
-        digestmod=hashlib.sha256
-    ).hexdigest()
-    
-    headers = {
-        "Signature": signature,
-        "Content-Type": "application/json"
-    }
-    
-    async with aiohttp.ClientSession() as session:
+    try:
+        result = await lava.post("/business/invoice/create", data)
+    except LavaError as e:
+        logger.error(f"Lava connection error: {e}")
+        return None, None
+    if result.get('status') == 200 or result.get('success'):
+        return result['data']['url'], result['data']['id']
+    logger.error(f"Lava create error: {result}")
+    return None, None
+
+# --- WEBHOOK SERVER ---
+# Все платёжные провайдеры приходят в один процесс: адаптер проверяет подпись и
+# разбирает тело, событие сохраняется в webhook_inbox и сразу подтверждается 200;
+# платёж подтверждает фоновый inbox_consumer.
+inbox_wakeup = asyncio.Event()
+
+class PaymentProvider:
+    name = ''
+
+    def verify(self, headers, body: bytes) -> bool:
+        raise NotImplementedError
+
+    def parse(self, data: dict) -> Optional[Tuple[str, int, float]]:
+        """Returns (payment id, order id, paid amount) for a successful payment, None for other statuses."""
+        raise NotImplementedError
+
+class LavaProvider(PaymentProvider):
+    name = 'lava'
+
+    def __init__(self, secret: str = LAVA_SECRET_KEY):
+        self._key = secret.encode('utf-8')
+
+    def verify(self, headers, body: bytes) -> bool:
+        signature = headers.get('Authorization') or headers.get('Signature')
+        if not signature:
+            return False
+        expected = hmac.new(self._key, msg=body, digestmod=hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature.strip().lower())
+
+    def parse(self, data: dict) -> Optional[Tuple[str, int, float]]:
+        order_id = int(data.get('orderId') or data.get('order_id'))
+        if data.get('status') not in ('success', 'completed'):
+            return None
+        amount = float(data['sum'] if 'sum' in data else data['amount'])
+        return str(data.get('invoice_id') or data.get('id') or f"order:{order_id}"), order_id, amount
+
+class CloudTipsProvider(PaymentProvider):
+    name = 'cloudtips'
+
+    def __init__(self, secret: str = CLOUDTIPS_SECRET):
+        self._key = secret.encode('utf-8')
+
+    def verify(self, headers, body: bytes) -> bool:
+        signature = headers.get('Content-HMAC') or headers.get('X-Content-HMAC')
+        if not self._key or not signature:
+            return False
+        expected = base64.b64encode(hmac.new(self._key, msg=body, digestmod=hashlib.sha256).digest()).decode()
+        return hmac.compare_digest(expected, signature.strip())
+
+    def parse(self, data: dict) -> Optional[Tuple[str, int, float]]:
+        order_id = int(data.get('payload') or 0)
+        if data.get('status') != 'PAID' or not order_id:
+            return None
+        return str(data.get('transactionId') or data.get('id') or f"order:{order_id}"), order_id, float(data['amount'])
+
+PAYMENT_PROVIDERS: Dict[str, PaymentProvider] = {p.name: p for p in (LavaProvider(), CloudTipsProvider())}
+
+async def ingest_payment_webhook(request, provider: PaymentProvider):
+    body = await request.read()
+    if not provider.verify(request.headers, body):
+        return web.Response(status=403, text="Invalid signature")
+    try:
+        event = provider.parse(json.loads(body))
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return web.Response(status=400, text="Bad payload")
+
+    if event is not None:
+        payment_id, order_id, amount = event
         try:
-            async with session.post(url, json=data, headers=headers) as resp:
-                result = await resp.json()
-                if result.get('status') == 200 or result.get('success'):
-                    return result['data']['url'], result['data']['id']
+            await db_execute('INSERT OR IGNORE INTO webhook_inbox (provider, event_id, order_id, amount, payload, received_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (provider.name, f"{provider.name}:{payment_id}", order_id, amount, body, now_iso()))
+        except sqlite3.Error as e:
+            logger.error(f"Webhook inbox error: {e}")
+            return web.Response(status=500, text="Error")
+        inbox_wakeup.set()
+    return web.Response(text="OK")
+
+async def handle_payment_webhook(request):
+    provider = PAYMENT_PROVIDERS.get(request.match_info['provider'])
+    if provider is None:
+        return web.Response(status=404, text="Unknown provider")
+    return await ingest_payment_webhook(request, provider)
+
+async def handle_lava_webhook(request):
+    # Старый адрес hookUrl для уже выставленных счетов Lava
+    return await ingest_payment_webhook(request, PAYMENT_PROVIDERS['lava'])
+
+async def inbox_consumer() -> None:
+    while True:
+        progressed = False
+        inbox_wakeup.clear()
+        try:
+            rows = await db_execute('SELECT id, provider, event_id, order_id, amount, attempts FROM webhook_inbox '
+                                    'WHERE processed_at IS NULL AND attempts < ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?) '
+                                    'ORDER BY id LIMIT ?', (INBOX_MAX_ATTEMPTS, now_iso(), INBOX_BATCH), fetch=True)
+            for inbox_id, provider, event_id, order_id, amount, attempts in rows:
+                try:
+                    await process_successful_payment(order_id, event_id, provider, amount)
+                except Exception as e:
+                    logger.error(f"Inbox event {event_id} failed (attempt {attempts + 1}/{INBOX_MAX_ATTEMPTS}): {e}")
+                    # Экспоненциальная пауза: кратковременный SQLITE_BUSY не сжигает все попытки за миллисекунды
+                    delay = min(INBOX_RETRY_BASE * 2 ** attempts, INBOX_RETRY_MAX)
+                    next_attempt_at = (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+                    await db_execute('UPDATE webhook_inbox SET attempts = attempts + 1, error=?, next_attempt_at=? WHERE id=?',
+                                     (str(e), next_attempt_at, inbox_id))
+                    if attempts + 1 >= INBOX_MAX_ATTEMPTS:
+                        # Больше не повторяем, но это реальный платёж — нужна ручная проверка
+                        notify(ADMIN_CHAT_ID, f"⚠️ Платёж {provider}:{event_id} по заказу #{order_id} не обработан "
+                                              f"после {INBOX_MAX_ATTEMPTS} попыток: {e}\nНужна ручная проверка.")
                 else:
-                    logger.error(f"Lava create error: {result}")
-                    return None, None
+                    await db_execute('UPDATE webhook_inbox SET processed_at=?, attempts = attempts + 1 WHERE id=?', (now_iso(), inbox_id))
+                    progressed = True
         except Exception as e:
-            logger.error(f"Lava connection error: {e}")
-            return None, None
+            logger.error(f"Inbox consumer error: {e}")
+        if not progressed:
+            try:
+                await asyncio.wait_for(inbox_wakeup.wait(), INBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-# --- WEBHOOK SERVER ---
-async def handle_lava_webhook(request):
-    try:
-        data = await request.json()
-        
-        req_signature = request.headers.get('Authorization') or request.headers.get('Signature')
-        body_bytes = await request.read()
-        calc_signature = hmac.new(
-            bytes(LAVA_SECRET_KEY, 'utf-8'),
-            msg=body_bytes,
-            digestmod=hashlib.sha256
-        ).hexdigest()
-        
-        if req_signature and req_signature != calc_signature:
-             return web.Response(status=403, text="Invalid signature")
+# --- Order lifecycle ---
+# pending_payment -> paid -> in_progress -> done; pending_payment -> expired; paid/in_progress/done -> refunded
+ORDER_TRANSITIONS: Dict[str, Tuple[str, ...]] = {
+    'paid': ('pending_payment',),
+    'in_progress': ('paid',),
+    'done': ('paid', 'in_progress'),
+    'expired': ('pending_payment',),
+    'refunded': ('paid', 'in_progress', 'done'),
+}
+ORDER_STATUS_TIMESTAMPS = {
+    'paid': 'paid_at',
+    'in_progress': 'started_at',
+    'done': 'done_at',
+    'expired': 'expired_at',
+    'refunded': 'refunded_at',
+}
 
-        order_id_str = data.get('orderId')
-        status = data.get('status')
-        
-        if status == 'success' or status == 'completed':
-            await process_successful_payment(int(order_id_str))
-            
-        return web.Response(text="OK")
-    except Exception as e:
-        logger.error(f"Webhook error: {e}")
-        return web.Response(status=500, text="Error")
-
-async def process_successful_payment(order_id: int):
-    row = db_execute('SELECT status, price, user_id, product_id, pubg_id FROM orders WHERE id=?', (order_id,), fetch=True)
-    if not row or row[0][0] == 'paid':
-        return
-    
-    status, price, user_id, prod_id, pubg_id = row[0]
-    
-    db_execute('UPDATE orders SET status=?, created_at=? WHERE id=?', ('paid', now_iso(), order_id))
-    
-    u_row = db_execute('SELECT invited_by, username, tg_id FROM users WHERE id=?', (user_id,), fetch=True)
-    if u_row:
-        inviter_id, buyer_username, buyer_tg_id = u_row[0]
-        
+def transition_order(conn: sqlite3.Connection, order_id: int, new_status: str, returning: str = '') -> sqlite3.Cursor:
+    """Conditional UPDATE: changes nothing (rowcount 0) if the order is not in an allowed source state."""
+    sources = ORDER_TRANSITIONS[new_status]
+    sql = (f"UPDATE orders SET status=?, {ORDER_STATUS_TIMESTAMPS[new_status]}=? "
+           f"WHERE id=? AND status IN ({', '.join('?' * len(sources))})")
+    if returning:
+        sql += f" RETURNING {returning}"
+    return conn.execute(sql, (new_status, now_iso(), order_id, *sources))
+
+def _expire_orders_tx(conn: sqlite3.Connection, cutoff: str) -> int:
+    expired = conn.execute("UPDATE orders SET status='expired', expired_at=? WHERE id IN "
+                           "(SELECT id FROM orders WHERE status='pending_payment' AND created_at < ? LIMIT ?) "
+                           "RETURNING id", (now_iso(), cutoff, SWEEP_BATCH)).fetchall()
+    for (order_id,) in expired:
+        _release_order_promo_tx(conn, order_id)
+    return len(expired)
+
+async def order_expiry_sweeper() -> None:
+    while True:
         try:
-            app = ApplicationBuilder().token(TG_BOT_TOKEN).build()
-            await app.bot.send_message(buyer_tg_id, f"✅ Оплата заказа #{order_id} прошла успешно! Ищем исполнителей...")
-            
-            prod_row = db_execute('SELECT name FROM products WHERE id=?', (prod_id,), fetch=True)
-            pname = prod_row[0][0] if prod_row else '?'
-            
-            admin_msg = (f"💰 НОВЫЙ ЗАКАЗ (LAVA) #{order_id}\n"
-                         f"Товар: {pname}\nСумма: {price}₽\nPUBG: {pubg_id}\n"
-                         f"Юзер: @{buyer_username}")
-            
-            kb = build_admin_keyboard_for_order(order_id, 'paid')
-            await app.bot.send_message(ADMIN_CHAT_ID, admin_msg, reply_markup=kb)
+            cutoff = (datetime.utcnow() - timedelta(seconds=ORDER_PAYMENT_TTL)).isoformat()
+            while await db_transaction(_expire_orders_tx, cutoff) == SWEEP_BATCH:
+                pass
+        except Exception as e:
+            logger.error(f"Order sweeper error: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+def _confirm_payment_tx(conn: sqlite3.Connection, event_id: str, order_id: int, amount: Optional[float] = None) -> Optional[dict]:
+    # Повторная доставка того же события — no-op по первичному ключу
+    if conn.execute('INSERT OR IGNORE INTO payment_events (event_id, order_id, created_at) VALUES (?, ?, ?)',
+                    (event_id, order_id, now_iso())).rowcount == 0:
+        return None
+    # amount нет только у событий, принятых до migration 11
+    if amount is not None:
+        row = conn.execute("SELECT price FROM orders WHERE id=? AND status='pending_payment'", (order_id,)).fetchone()
+        if row and round(amount, 2) < round(row[0], 2):
+            # Недоплата: заказ остаётся ждать оплаты, деньги разбирает админ
+            return {'order_id': order_id, 'underpaid': True, 'amount': amount, 'price': row[0]}
+    row = transition_order(conn, order_id, 'paid', returning='price, user_id, product_id, pubg_id, promo_code').fetchall()
+    if not row:
+        status = conn.execute('SELECT status FROM orders WHERE id=?', (order_id,)).fetchone()
+        # Новое событие, но заказ уже не ждёт оплаты (истёк, оплачен повторно, не найден) — деньги получены,
+        # заказ не выполняется: такой платёж всегда уходит админам на ручную проверку
+        return {'order_id': order_id, 'late': True, 'status': status[0] if status else None}
+    price, user_id, prod_id, pubg_id, promo_code = row[0]
+    conn.execute('DELETE FROM promo_reservations WHERE order_id=?', (order_id,))
+    info = {'order_id': order_id, 'price': price, 'pubg_id': pubg_id, 'bonus': 0, 'late': False}
+    u_row = conn.execute('SELECT invited_by, username, tg_id FROM users WHERE id=?', (user_id,)).fetchone()
+    if u_row is None:
+        # Заказ уже оплачен, но покупателя нет — None выглядел бы как дубль, и заказ никто бы не выполнил
+        return {'order_id': order_id, 'late': True, 'status': 'paid', 'missing_buyer': True, 'pubg_id': pubg_id}
+    info['inviter_id'], info['buyer_username'], info['buyer_tg_id'] = u_row
+    if info['inviter_id']:
+        info['bonus'] = price * REFERRAL_PERCENT
+        conn.execute('UPDATE users SET balance = balance + ? WHERE tg_id=?', (info['bonus'], info['inviter_id']))
+    bump_daily_stats(conn, orders_paid=1, revenue=price, referral_bonus=info['bonus'], promo_orders=int(bool(promo_code)))
+    prod_row = conn.execute('SELECT name FROM products WHERE id=?', (prod_id,)).fetchone()
+    info['product_name'] = prod_row[0] if prod_row else '?'
+    return info
 
+async def process_successful_payment(order_id: int, event_id: str, provider: str = 'lava', amount: Optional[float] = None):
+    info = await db_transaction(_confirm_payment_tx, event_id, order_id, amount)
+    if info is None:
+        return
+    if info.get('underpaid'):
+        logger.warning(f"Payment {event_id} for order #{order_id}: paid {info['amount']}, price {info['price']}")
+        notify(ADMIN_CHAT_ID, f"⚠️ Недоплата ({provider.upper()}) по заказу #{order_id}: получено {info['amount']}₽ "
+                              f"вместо {info['price']}₽.\nПлатёж: {event_id}\nЗаказ не оплачен, нужна ручная проверка или возврат.")
+        return
+    if info['late']:
+        status = info['status']
+        logger.warning(f"Payment {event_id} arrived for order #{order_id} in status {status}")
+        reason = {'expired': 'по истёкшему заказу', None: 'по несуществующему заказу'}.get(status, f'по заказу в статусе {status}')
+        if info.get('missing_buyer'):
+            reason = f"по заказу без покупателя в базе (PUBG: {info['pubg_id']})"
+        notify(ADMIN_CHAT_ID, f"⚠️ Оплата ({provider.upper()}) пришла {reason} #{order_id}.\n"
+                              f"Платёж: {event_id}\nНужна ручная проверка или возврат.")
+        return
+
+    notify(info['buyer_tg_id'], f"✅ Оплата заказа #{order_id} прошла успешно! Ищем исполнителей...")
+
+    admin_msg = (f"💰 НОВЫЙ ЗАКАЗ ({provider.upper()}) #{order_id}\n"
+                 f"Товар: {info['product_name']}\nСумма: {info['price']}₽\nPUBG: {info['pubg_id']}\n"
+                 f"Юзер: @{info['buyer_username']}")
+    kb = build_admin_keyboard_for_order(order_id, 'paid')
+    notify(ADMIN_CHAT_ID, admin_msg, reply_markup=kb)
+
+    if info['bonus']:
+        bump_user_cache(info['inviter_id'], 'balance', info['bonus'])
+        notify(info['inviter_id'], f"🎉 Ваш реферал сделал заказ! Вам начислено +{info['bonus']}₽")
+
+# --- Worker settlement ---
+def _settle_orders_tx(conn: sqlite3.Connection) -> int:
+    # idx_orders_status_id (status, id) выглядит для планировщика не хуже, но тянет все выполненные заказы за всю историю
+    orders = conn.execute("SELECT id, price FROM orders INDEXED BY idx_orders_unsettled "
+                          "WHERE status='done' AND settled_at IS NULL ORDER BY id LIMIT ?", (SETTLE_BATCH,)).fetchall()
+    now = now_iso()
+    for order_id, price in orders:
+        workers = conn.execute('SELECT worker_id, worker_username FROM order_workers WHERE order_id=?', (order_id,)).fetchall()
+        share = round(price * WORKER_PERCENT / len(workers), 2) if workers else 0
+        for worker_id, username in workers:
+            if conn.execute('INSERT OR IGNORE INTO worker_payouts (order_id, worker_id, amount, created_at) VALUES (?, ?, ?, ?)',
+                            (order_id, worker_id, share, now)).rowcount:
+                conn.execute('INSERT INTO worker_stats (worker_id, worker_username, orders_count, total_earned, updated_at) '
+                             'VALUES (?, ?, 1, ?, ?) ON CONFLICT(worker_id) DO UPDATE SET '
+                             'orders_count = orders_count + 1, total_earned = total_earned + excluded.total_earned, '
+                             'worker_username = excluded.worker_username, updated_at = excluded.updated_at',
+                             (worker_id, username, share, now))
+        conn.execute('UPDATE orders SET settled_at=? WHERE id=?', (now, order_id))
+    return len(orders)
+
+async def settle_done_orders() -> int:
+    total = 0
+    while True:
+        settled = await db_transaction(_settle_orders_tx)
+        total += settled
+        if settled < SETTLE_BATCH:
+            return total
+
+async def settlement_worker() -> None:
+    while True:
+        try:
+            settled = await settle_done_orders()
+            if settled:
+                logger.info(f"Settled {settled} orders")
         except Exception as e:
-            logger.error(f"Notification error: {e}")
+            logger.error(f"Settlement error: {e}")
+        await asyncio.sleep(SETTLE_INTERVAL)
+
+def _add_review_tx(conn: sqlite3.Connection, order_id: int, buyer_tg_id: int, rating: int) -> bool:
+    row = conn.execute("SELECT u.id FROM orders o JOIN users u ON u.id = o.user_id "
+                       "WHERE o.id=? AND u.tg_id=? AND o.status='done'", (order_id, buyer_tg_id)).fetchone()
+    if row is None:
+        return False
+    added = False
+    for (worker_id,) in conn.execute('SELECT worker_id FROM order_workers WHERE order_id=?', (order_id,)).fetchall():
+        if conn.execute('INSERT OR IGNORE INTO reviews (order_id, buyer_id, worker_id, rating, created_at) VALUES (?, ?, ?, ?, ?)',
+                        (order_id, row[0], worker_id, rating, now_iso())).rowcount:
+            conn.execute('INSERT INTO worker_stats (worker_id, rating_sum, rating_count, updated_at) VALUES (?, ?, 1, ?) '
+                         'ON CONFLICT(worker_id) DO UPDATE SET rating_sum = rating_sum + excluded.rating_sum, '
+                         'rating_count = rating_count + 1, updated_at = excluded.updated_at',
+                         (worker_id, rating, now_iso()))
+            added = True
+    return added
+
+# --- Broadcasts ---
+broadcast_wakeup = asyncio.Event()
+
+def _create_broadcast_tx(conn: sqlite3.Connection, text: str, admin_tg_id: int) -> Tuple[int, int]:
+    total = conn.execute('SELECT COUNT(*) FROM users WHERE blocked_at IS NULL').fetchone()[0]
+    cur = conn.execute('INSERT INTO broadcasts (text, created_by, created_at, total) VALUES (?, ?, ?, ?)',
+                       (text, admin_tg_id, now_iso(), total))
+    return cur.lastrowid, total
 
-        if inviter_id:
-            bonus = price * REFERRAL_PERCENT
-            db_execute('UPDATE users SET balance = balance + ? WHERE tg_id=?', (bonus, inviter_id))
+def _checkpoint_broadcast_tx(conn: sqlite3.Connection, broadcast_id: int, last_user_id: int,
+                             sent: int, failed: int, blocked_ids: List[int]) -> bool:
+    if blocked_ids:
+        conn.executemany('UPDATE users SET blocked_at=? WHERE id=?', [(now_iso(), uid) for uid in blocked_ids])
+    return conn.execute("UPDATE broadcasts SET last_user_id=?, sent = sent + ?, failed = failed + ?, blocked = blocked + ? "
+                        "WHERE id=? AND status='running'",
+                        (last_user_id, sent, failed, len(blocked_ids), broadcast_id)).rowcount > 0
+
+class BroadcastEngine:
+    """Sends one broadcast in keyset chunks of users, checkpointing progress after each chunk."""
+
+    def __init__(self, bot, rate: float = BROADCAST_RATE, senders: int = BROADCAST_SENDERS):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.senders = senders
+
+    async def _send(self, tg_id: int, text: str) -> str:
+        for attempt in range(OUTBOX_RETRIES + 1):
+            await self.bucket.acquire()
+            # Рассылка тратит общий лимит бота, но не больше своей доли — интерактив не голодает
+            if outbox is not None:
+                await outbox.bucket.acquire()
             try:
-                await app.bot.send_message(inviter_id, f"🎉 Ваш реферал сделал заказ! Вам начислено +{bonus}₽")
-            except: pass
+                await self.bot.send_message(tg_id, text)
+                return 'sent'
+            except RetryAfter as e:
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if hasattr(delay, 'total_seconds') else delay)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.warning(f"Broadcast: message to {tg_id} rejected: {e}")
+                return 'failed'
+            except NetworkError as e:
+                logger.warning(f"Broadcast: network error for {tg_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.warning(f"Broadcast: message to {tg_id} failed: {e}")
+                return 'failed'
+            except Exception as e:
+                # Ошибка одного получателя не должна ронять весь чанк: иначе он уйдёт повторно тем, кто уже получил
+                logger.error(f"Broadcast: unexpected error for {tg_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _send_chunk(self, recipients: List[tuple], text: str) -> Dict[str, List[int]]:
+        results: Dict[str, List[int]] = {'sent': [], 'failed': [], 'blocked': []}
+        it = iter(recipients)
+
+        async def sender():
+            for user_id, tg_id in it:
+                results[await self._send(tg_id, text)].append(user_id)
+
+        await asyncio.gather(*(sender() for _ in range(min(self.senders, len(recipients)))))
+        return results
+
+    async def run(self, broadcast_id: int) -> Optional[str]:
+        row = await db_execute('SELECT text, status, total, last_user_id, sent, failed, blocked FROM broadcasts WHERE id=?',
+                               (broadcast_id,), fetch=True)
+        if not row or row[0][1] != 'running':
+            return None
+        text, _, total, last_id, sent, failed, blocked = row[0]
+        started, started_done = time.monotonic(), sent + failed + blocked
+        reported = started
+        while True:
+            recipients = await db_execute('SELECT id, tg_id FROM users WHERE id > ? AND blocked_at IS NULL ORDER BY id LIMIT ?',
+                                          (last_id, BROADCAST_CHUNK), fetch=True)
+            if not recipients:
+                break
+            res = await self._send_chunk(recipients, text)
+            last_id = recipients[-1][0]
+            if not await db_transaction(_checkpoint_broadcast_tx, broadcast_id, last_id,
+                                        len(res['sent']), len(res['failed']), res['blocked']):
+                return 'cancelled'
+            sent, failed, blocked = sent + len(res['sent']), failed + len(res['failed']), blocked + len(res['blocked'])
+            now = time.monotonic()
+            if now - reported >= BROADCAST_REPORT_INTERVAL:
+                reported = now
+                done = sent + failed + blocked
+                speed = (done - started_done) / (now - started)
+                eta = (total - done) / speed if speed > 0 else 0
+                notify(ADMIN_CHAT_ID, f"📣 Рассылка #{broadcast_id}: {done}/{total}, {speed:.1f} сообщ./с, "
+                                      f"осталось ~{int(eta // 60)} мин.")
+        await db_execute("UPDATE broadcasts SET status='done', finished_at=? WHERE id=? AND status='running'",
+                         (now_iso(), broadcast_id))
+        elapsed = time.monotonic() - started
+        notify(ADMIN_CHAT_ID, f"✅ Рассылка #{broadcast_id} завершена за {int(elapsed)} с: "
+                              f"доставлено {sent}, ошибок {failed}, заблокировали бота {blocked}.")
+        return 'done'
+
+async def broadcast_worker(bot) -> None:
+    # Одна рассылка за раз; незавершённые после рестарта продолжаются с контрольной точки
+    engine = BroadcastEngine(bot)
+    while True:
+        broadcast_wakeup.clear()
+        try:
+            rows = await db_execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1", fetch=True)
+            if rows:
+                result = await engine.run(rows[0][0])
+                logger.info(f"Broadcast #{rows[0][0]} {result}")
+                continue
+        except Exception as e:
+            logger.error(f"Broadcast error: {e}")
+        # /broadcast может прийти в процесс-воркер — сигнал туда не дойдёт, поэтому опрашиваем и по таймеру
+        try:
+            await asyncio.wait_for(broadcast_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# --- Admin reports ---
+ADMIN_ORDER_FILTERS = ('paid', 'in_progress', 'done', 'pending_payment', 'expired', 'refunded')
+DAILY_STATS_COLUMNS = ('new_users', 'referred_users', 'orders_paid', 'revenue', 'referral_bonus',
+                       'promo_orders', 'refunds', 'refunded_amount')
+
+def bump_daily_stats(conn: sqlite3.Connection, **deltas) -> None:
+    cols = ', '.join(deltas)
+    conn.execute(f"INSERT INTO daily_stats (day, {cols}) VALUES (?, {', '.join('?' * len(deltas))}) "
+                 f"ON CONFLICT(day) DO UPDATE SET " + ', '.join(f"{c} = {c} + excluded.{c}" for c in deltas),
+                 (datetime.utcnow().date().isoformat(), *deltas.values()))
+
+async def list_orders(status: Optional[str] = None, before_id: Optional[int] = None,
+                      limit: int = ADMIN_PAGE_SIZE) -> Tuple[List[tuple], Optional[int]]:
+    """Keyset page of orders, newest first; returns (rows, cursor for the next page or None)."""
+    where, params = [], []
+    if status:
+        where.append('o.status=?')
+        params.append(status)
+    if before_id:
+        where.append('o.id<?')
+        params.append(before_id)
+    rows = await db_execute('SELECT o.id, o.status, o.price, o.created_at, o.pubg_id, u.username FROM orders o '
+                            'LEFT JOIN users u ON u.id = o.user_id '
+                            + (f"WHERE {' AND '.join(where)} " if where else '') +
+                            'ORDER BY o.id DESC LIMIT ?', (*params, limit), fetch=True)
+    return rows, (rows[-1][0] if len(rows) == limit else None)
+
+async def stats_summary(days: int) -> dict:
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    rows = await db_execute(f"SELECT day, {', '.join(DAILY_STATS_COLUMNS)} FROM daily_stats WHERE day >= ? ORDER BY day",
+                            (since,), fetch=True)
+    totals = {c: sum(r[i + 1] or 0 for r in rows) for i, c in enumerate(DAILY_STATS_COLUMNS)}
+    return {'since': since, 'days': days, 'totals': totals,
+            'daily': [dict(zip(('day',) + DAILY_STATS_COLUMNS, r)) for r in rows]}
+
+def render_orders_page(rows: List[tuple], status: Optional[str], cursor: Optional[int]):
+    title = ORDER_STATUS_LABELS.get(status, status) if status else 'все'
+    lines = [f"📋 Заказы ({title}):"]
+    for oid, st, price, created_at, pubg_id, username in rows:
+        lines.append(f"#{oid} {ORDER_STATUS_LABELS.get(st, st)} — {price}₽, @{username or '?'}, {(created_at or '')[:16]}")
+    if not rows:
+        lines.append("Нет заказов.")
+    flt = status or '-'
+    kb = [[InlineKeyboardButton(label, callback_data=f'orders:{key}:0')
+           for key, label in (('-', 'Все'), ('paid', '💰'), ('in_progress', '▶'), ('done', '🏁'))]]
+    if cursor:
+        kb.append([InlineKeyboardButton('▶️ Дальше', callback_data=f'orders:{flt}:{cursor}')])
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+def render_stats(summary: dict) -> str:
+    t = summary['totals']
+    return (f"📊 Статистика за {summary['days']} дн. (с {summary['since']}):\n"
+            f"👤 Новых пользователей: {t['new_users']} (по рефссылкам: {t['referred_users']})\n"
+            f"💰 Оплачено заказов: {t['orders_paid']} на {t['revenue']:.2f}₽\n"
+            f"🎟 С промокодом: {t['promo_orders']}\n"
+            f"🎉 Реферальных начислений: {t['referral_bonus']:.2f}₽\n"
+            f"↩️ Возвратов: {t['refunds']} на {t['refunded_amount']:.2f}₽")
+
+def _admin_api_authorized(request) -> bool:
+    token = request.headers.get('Authorization', '')
+    return bool(ADMIN_API_TOKEN) and hmac.compare_digest(token, f"Bearer {ADMIN_API_TOKEN}")
+
+async def handle_admin_orders(request):
+    if not _admin_api_authorized(request):
+        return web.Response(status=404)
+    q = request.query
+    status = q.get('status') or None
+    if status and status not in ADMIN_ORDER_FILTERS:
+        return web.json_response({'error': 'unknown status'}, status=400)
+    try:
+        cursor = int(q['cursor']) if q.get('cursor') else None
+        limit = min(max(int(q.get('limit', ADMIN_PAGE_SIZE)), 1), ADMIN_MAX_PAGE_SIZE)
+    except ValueError:
+        return web.json_response({'error': 'bad cursor or limit'}, status=400)
+    rows, next_cursor = await list_orders(status, cursor, limit)
+    keys = ('id', 'status', 'price', 'created_at', 'pubg_id', 'username')
+    return web.json_response({'orders': [dict(zip(keys, r)) for r in rows], 'next_cursor': next_cursor})
+
+async def handle_admin_stats(request):
+    if not _admin_api_authorized(request):
+        return web.Response(status=404)
+    try:
+        days = min(max(int(request.query.get('days', '7')), 1), 366)
+    except ValueError:
+        return web.json_response({'error': 'bad days'}, status=400)
+    return web.json_response(await stats_summary(days))
+
+async def handle_metrics(request):
+    if not _admin_api_authorized(request):
+        return web.Response(status=404)
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+# --- Promo reservations ---
+class PromoUnavailable(Exception):
+    pass
+
+def _create_order_tx(conn: sqlite3.Connection, user_db_id: int, prod_id: int, price: float,
+                     pubg_id: Optional[str], promo_code: Optional[str]) -> int:
+    if promo_code:
+        # Атомарное списание активации: условие в самом UPDATE, а не отдельным SELECT
+        if conn.execute('UPDATE promocodes SET activations_left = activations_left - 1 WHERE code=? AND activations_left > 0',
+                        (promo_code,)).rowcount == 0:
+            raise PromoUnavailable(promo_code)
+        if conn.execute('INSERT OR IGNORE INTO used_promocodes (user_id, code) VALUES (?, ?)',
+                        (user_db_id, promo_code)).rowcount == 0:
+            raise PromoUnavailable(promo_code)
+    order_id = conn.execute('INSERT INTO orders (user_id, product_id, price, status, created_at, pubg_id, promo_code) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id',
+                            (user_db_id, prod_id, price, 'pending_payment', now_iso(), pubg_id, promo_code)).fetchall()[0][0]
+    if promo_code:
+        expires_at = (datetime.utcnow() + timedelta(seconds=ORDER_PAYMENT_TTL)).isoformat()
+        conn.execute('INSERT INTO promo_reservations (order_id, code, user_id, expires_at) VALUES (?, ?, ?, ?)',
+                     (order_id, promo_code, user_db_id, expires_at))
+    return order_id
+
+def _release_promos(conn: sqlite3.Connection, reservations: List[tuple]) -> None:
+    for order_id, code, user_db_id in reservations:
+        conn.execute('UPDATE promocodes SET activations_left = activations_left + 1 WHERE code=?', (code,))
+        conn.execute('DELETE FROM used_promocodes WHERE user_id=? AND code=?', (user_db_id, code))
+
+def _release_order_promo_tx(conn: sqlite3.Connection, order_id: int) -> None:
+    _release_promos(conn, conn.execute('DELETE FROM promo_reservations WHERE order_id=? RETURNING order_id, code, user_id',
+                                       (order_id,)).fetchall())
+
+def _abandon_order_tx(conn: sqlite3.Connection, order_id: int) -> None:
+    if transition_order(conn, order_id, 'expired').rowcount:
+        _release_order_promo_tx(conn, order_id)
 
 # --- UI / Keyboards ---
 MAIN_MENU = ReplyKeyboardMarkup(
@@ -314,7 +1715,8 @@ DOCS_MENU = ReplyKeyboardMarkup(
 )
 CANCEL_BUTTON = ReplyKeyboardMarkup([[KeyboardButton('↩️ Назад')]], resize_keyboard=True)
 ADMIN_PANEL_KB = ReplyKeyboardMarkup(
-    [[KeyboardButton('➕ Добавить товар'), KeyboardButton('📋 Список заказов')], [KeyboardButton('↩️ Назад')]],
+    [[KeyboardButton('➕ Добавить товар'), KeyboardButton('📋 Список заказов')],
+     [KeyboardButton('📊 Статистика'), KeyboardButton('↩️ Назад')]],
     resize_keyboard=True,
 )
 
@@ -331,34 +1733,45 @@ def build_admin_keyboard_for_order(order_id: int, order_status: str) -> InlineKe
 
 # --- HANDLERS ---
 
+def _register_user_tx(conn: sqlite3.Connection, tg_id: int, username: str, referrer_id: Optional[int]) -> Optional[int]:
+    row = conn.execute('INSERT OR IGNORE INTO users (tg_id, username, registered_at, balance, invited_by) VALUES (?, ?, ?, 0, ?) RETURNING id',
+                       (tg_id, username, now_iso(), referrer_id)).fetchall()
+    if not row:
+        # Профиль появился между проверкой в start и вставкой
+        conn.execute('UPDATE users SET blocked_at=NULL WHERE tg_id=? AND blocked_at IS NOT NULL', (tg_id,))
+        return None
+    bump_daily_stats(conn, new_users=1, referred_users=int(referrer_id is not None))
+    return row[0][0]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     args = context.args
     
-    exists = db_execute('SELECT id FROM users WHERE tg_id=?', (user.id,), fetch=True)
-    if not exists:
+    profile = await get_user_profile(user.id)
+    if not profile:
         referrer_id = None
         if args and args[0].isdigit():
             referrer_id = int(args[0])
             if referrer_id == user.id: referrer_id = None
         
-        db_execute('INSERT INTO users (tg_id, username, registered_at, balance, invited_by) VALUES (?, ?, ?, 0, ?)',
-                   (user.id, user.username or '', now_iso(), referrer_id))
-        
-        if referrer_id:
-            try: await context.bot.send_message(referrer_id, f"👤 По вашей ссылке пришел новый пользователь!")
-            except: pass
+        uid = await db_transaction(_register_user_tx, user.id, user.username or '', referrer_id)
+        if uid:
+            user_cache.put(user.id, {'id': uid, 'pubg_id': None, 'balance': 0.0, 'ref_count': 0})
+            if referrer_id:
+                bump_user_cache(referrer_id, 'ref_count', 1)
+                notify(referrer_id, "👤 По вашей ссылке пришел новый пользователь!")
+    else:
+        # Пользователь вернулся после блокировки бота — снова получает рассылки
+        await db_execute('UPDATE users SET blocked_at=NULL WHERE tg_id=? AND blocked_at IS NOT NULL', (user.id,))
     
     text = f"Привет, {user.first_name}!\nДобро пожаловать в Metro Shop.\n\n🔗 Твоя реферальная ссылка:\nhttps://t.me/{context.bot.username}?start={user.id}"
     await update.message.reply_text(text, reply_markup=MAIN_MENU)
 
 async def balance_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    row = db_execute('SELECT balance FROM users WHERE tg_id=?', (user.id,), fetch=True)
-    balance = row[0][0] if row else 0.0
-    
-    refs = db_execute('SELECT COUNT(*) FROM users WHERE invited_by=?', (user.id,), fetch=True)
-    ref_count = refs[0][0] if refs else 0
+    profile = await get_user_profile(user.id)
+    balance = profile['balance'] if profile else 0.0
+    ref_count = profile['ref_count'] if profile else 0
     
     await update.message.reply_text(
         f"💰 Ваш баланс: {balance}₽\n👥 Приглашено друзей: {ref_count}\n\nВы получаете {int(REFERRAL_PERCENT*100)}% от покупок рефералов!",
@@ -372,15 +1785,17 @@ async def promo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     code = text[1].upper()
     
-    row = db_execute('SELECT discount_percent, activations_left FROM promocodes WHERE code=?', (code,), fetch=True)
+    row = await db_execute('SELECT discount_percent, activations_left FROM promocodes WHERE code=?', (code,), fetch=True)
     if not row or row[0][1] <= 0:
         await update.message.reply_text("❌ Промокод недействителен.")
         return
     
     user = update.effective_user
-    uid_row = db_execute('SELECT id FROM users WHERE tg_id=?', (user.id,), fetch=True)
-    uid = uid_row[0][0]
-    used = db_execute('SELECT 1 FROM used_promocodes WHERE user_id=? AND code=?', (uid, code), fetch=True)
+    profile = await get_user_profile(user.id)
+    if not profile:
+        await update.message.reply_text("Сначала нажмите /start")
+        return
+    used = await db_execute('SELECT 1 FROM used_promocodes WHERE user_id=? AND code=?', (profile['id'], code), fetch=True)
     if used:
         await update.message.reply_text("❌ Вы уже использовали этот код.")
         return
@@ -388,15 +1803,14 @@ async def promo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     context.user_data['promo'] = {'code': code, 'percent': row[0][0]}
     await update.message.reply_text(f"✅ Промокод на {row[0][0]}% активирован на следующий заказ!")
 
-async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int) -> None:
     query = update.callback_query
     await query.answer()
-    pid = int(query.data.split(':')[1])
     user = query.from_user
     
-    p = db_execute('SELECT id, name, price FROM products WHERE id=?', (pid,), fetch=True)
+    p = await catalog.get(pid)
     if not p: return
-    prod_id, name, base_price = p[0]
+    prod_id, name, base_price, _ = p
     
     price = base_price
     promo_data = context.user_data.get('promo')
@@ -407,19 +1821,27 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         price = price * (1 - percent / 100)
         promo_code_used = promo_data['code']
     
-    u_row = db_execute('SELECT id, pubg_id FROM users WHERE tg_id=?', (user.id,), fetch=True)
-    user_db_id, pubg_id = u_row[0]
-    
-    cur = db_execute('INSERT INTO orders (user_id, product_id, price, status, created_at, pubg_id, promo_code) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id',
-               (user_db_id, prod_id, price, 'pending_payment', now_iso(), pubg_id, promo_code_used), fetch=True)
-    order_id = cur[0][0]
-    
-    msg = await query.message.reply_text("⏳ Создаем ссылку на оплату...")
+    profile = await get_user_profile(user.id)
+    if not profile:
+        await query.message.reply_text("Сначала нажмите /start")
+        return
+    user_db_id, pubg_id = profile['id'], profile['pubg_id']
     
     if LAVA_PROJECT_ID == 'YOUR_LAVA_PROJECT_ID_HERE':
-        await msg.edit_text("❌ Ошибка: Владелец бота не настроил LAVA_PROJECT_ID.")
+        await query.message.reply_text("❌ Ошибка: Владелец бота не настроил LAVA_PROJECT_ID.")
         return
 
+    try:
+        order_id = await db_transaction(_create_order_tx, user_db_id, prod_id, price, pubg_id, promo_code_used)
+    except PromoUnavailable:
+        context.user_data.pop('promo', None)
+        await query.message.reply_text("❌ Промокод больше недоступен. Нажмите «Купить» ещё раз, чтобы оформить заказ без скидки.")
+        return
+    if promo_code_used:
+        context.user_data.pop('promo', None)
+    
+    msg = await query.message.reply_text("⏳ Создаем ссылку на оплату...")
+
     pay_url, pay_id = await create_lava_invoice(order_id, price)
     
     if pay_url:
@@ -428,121 +1850,819 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             f"Заказ #{order_id}\nТовар: {name}\nК оплате: {price}₽\n\nНажмите кнопку ниже для оплаты:",
             reply_markup=kb
         )
-        db_execute('UPDATE orders SET payment_id=? WHERE id=?', (pay_id, order_id))
-        
-        if promo_code_used:
-             db_execute('INSERT INTO used_promocodes (user_id, code) VALUES (?, ?)', (user_db_id, promo_code_used))
-             db_execute('UPDATE promocodes SET activations_left = activations_left - 1 WHERE code=?', (promo_code_used,))
-             context.user_data.pop('promo', None)
+        await db_execute('UPDATE orders SET payment_id=? WHERE id=?', (pay_id, order_id))
     else:
+        await db_transaction(_abandon_order_tx, order_id)
+        if promo_code_used:
+            context.user_data['promo'] = promo_data
         await msg.edit_text("Ошибка при создании платежа. Попробуйте позже.")
 
 # --- Standard Handlers ---
+def render_catalog_page(items: List[tuple], page: int):
+    pages = max(1, -(-len(items) // CATALOG_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    chunk = items[page * CATALOG_PAGE_SIZE:(page + 1) * CATALOG_PAGE_SIZE]
+    text = f"📦 Каталог (стр. {page + 1}/{pages}):\n\n" + "\n".join(f"• {name} - {price}₽" for _, name, price, _ in chunk)
+    rows = [[InlineKeyboardButton(f"🛒 {name} - {price}₽", callback_data=f'buy:{pid}')] for pid, name, price, _ in chunk]
+    if pages > 1:
+        rows.append([InlineKeyboardButton('◀️', callback_data=f'cat:{(page - 1) % pages}'),
+                     InlineKeyboardButton(f'{page + 1}/{pages}', callback_data='noop'),
+                     InlineKeyboardButton('▶️', callback_data=f'cat:{(page + 1) % pages}')])
+    photos = [InputMediaPhoto(photo, caption=f"{name} - {price}₽") for _, name, price, photo in chunk if photo]
+    return text, InlineKeyboardMarkup(rows), photos
+
+async def send_catalog_page(message, items: List[tuple], page: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Не больше двух запросов к API на страницу: альбом с фото + список с кнопками
+    text, kb, photos = render_catalog_page(items, page)
+    album = []
+    if len(photos) == 1:
+        album = [await message.reply_photo(photos[0].media, caption=photos[0].caption)]
+    elif photos:
+        album = await message.reply_media_group(photos)
+    # id альбома запоминаем, чтобы при листании удалить его вместе со старой страницей
+    context.user_data['catalog_album'] = [m.message_id for m in album]
+    await message.reply_text(text, reply_markup=kb)
+
+async def delete_catalog_album(message, context: ContextTypes.DEFAULT_TYPE) -> None:
+    album = context.user_data.pop('catalog_album', None)
+    if album:
+        try: await context.bot.delete_messages(message.chat_id, album)
+        except TelegramError: pass  # старше 48 часов или уже удалён пользователем
+
 async def products_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    prods = db_execute('SELECT id, name, price, photo FROM products', fetch=True)
+    prods = await catalog.items()
     if not prods:
         await update.message.reply_text('Пусто.')
         return
-    for pid, name, price, photo in prods:
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton('Купить', callback_data=f'buy:{pid}')]])
-        if photo: await update.message.reply_photo(photo, caption=f"{name} - {price}₽", reply_markup=kb)
-        else: await update.message.reply_text(f"{name} - {price}₽", reply_markup=kb)
+    await send_catalog_page(update.message, prods, 0, context)
+
+async def catalog_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> None:
+    query = update.callback_query
+    await query.answer()
+    prods = await catalog.items()
+    text, kb, photos = render_catalog_page(prods, page)
+    await delete_catalog_album(query.message, context)
+    if photos:
+        # Альбом нельзя отредактировать — переотправляем страницу целиком
+        try: await query.message.delete()
+        except BadRequest: pass
+        await send_catalog_page(query.message, prods, page, context)
+        return
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except BadRequest:
+        pass  # та же страница — "message is not modified"
+
+async def pubg_bind_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data['awaiting_pubg'] = True
+    await update.message.reply_text("Отправьте ваш PUBG ID (только цифры):", reply_markup=CANCEL_BUTTON)
+
+async def pubg_id_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    pubg_id = update.message.text.strip()
+    if not pubg_id.isdigit() or not PUBG_ID_LENGTH[0] <= len(pubg_id) <= PUBG_ID_LENGTH[1]:
+        await update.message.reply_text("❌ Неверный PUBG ID. Попробуйте ещё раз или нажмите «↩️ Назад».")
+        return
+    context.user_data.pop('awaiting_pubg', None)
+    user = update.effective_user
+    await db_execute('UPDATE users SET pubg_id=? WHERE tg_id=?', (pubg_id, user.id))
+    user_cache.update(user.id, pubg_id=pubg_id)
+    await update.message.reply_text(f"✅ PUBG ID {pubg_id} привязан.", reply_markup=MAIN_MENU)
+
+# --- Worker assignment ---
+ORDER_STATUS_LABELS = {
+    'pending_payment': '⏳ ожидает оплаты',
+    'paid': '💰 оплачен',
+    'in_progress': '▶ в работе',
+    'done': '🏁 выполнен',
+    'expired': '⌛ истёк',
+    'refunded': '↩️ возврат',
+}
+
+def _order_card_tx(conn: sqlite3.Connection, order_id: int) -> Optional[Tuple[str, str, int]]:
+    row = conn.execute('SELECT o.status, o.price, o.pubg_id, p.name, u.username, u.tg_id FROM orders o '
+                       'LEFT JOIN products p ON p.id = o.product_id LEFT JOIN users u ON u.id = o.user_id '
+                       'WHERE o.id=?', (order_id,)).fetchone()
+    if row is None:
+        return None
+    status, price, pubg_id, pname, username, buyer_tg_id = row
+    workers = [f"@{w}" if w else str(wid) for wid, w in conn.execute(
+        'SELECT worker_id, worker_username FROM order_workers WHERE order_id=? ORDER BY id', (order_id,))]
+    text = (f"📦 Заказ #{order_id} — {ORDER_STATUS_LABELS.get(status, status)}\n"
+            f"Товар: {pname or '?'}\nСумма: {price}₽\nPUBG: {pubg_id}\nЮзер: @{username}\n"
+            f"👷 Исполнители ({len(workers)}/{MAX_WORKERS_PER_ORDER}): {', '.join(workers) or '—'}")
+    return text, status, buyer_tg_id
+
+def _take_order_tx(conn: sqlite3.Connection, order_id: int, worker_id: int, worker_username: str) -> str:
+    row = conn.execute('SELECT status FROM orders WHERE id=?', (order_id,)).fetchone()
+    if row is None or row[0] not in ('paid', 'in_progress'):
+        return 'closed'
+    # Счёт и вставка в одной IMMEDIATE-транзакции: параллельные «Беру» не превысят лимит
+    inserted = conn.execute('INSERT OR IGNORE INTO order_workers (order_id, worker_id, worker_username, taken_at) '
+                            'SELECT ?, ?, ?, ? WHERE (SELECT COUNT(*) FROM order_workers WHERE order_id=?) < ?',
+                            (order_id, worker_id, worker_username, now_iso(), order_id, MAX_WORKERS_PER_ORDER)).rowcount
+    if inserted:
+        return 'taken'
+    exists = conn.execute('SELECT 1 FROM order_workers WHERE order_id=? AND worker_id=?', (order_id, worker_id)).fetchone()
+    return 'already' if exists else 'full'
+
+def _leave_order_tx(conn: sqlite3.Connection, order_id: int, worker_id: int) -> bool:
+    return conn.execute("DELETE FROM order_workers WHERE order_id=? AND worker_id=? "
+                        "AND (SELECT status FROM orders WHERE id=?) IN ('paid', 'in_progress')",
+                        (order_id, worker_id, order_id)).rowcount > 0
+
+def _set_order_status_tx(conn: sqlite3.Connection, order_id: int, new_status: str, actor_id: int, is_admin: bool) -> str:
+    if not is_admin and not conn.execute('SELECT 1 FROM order_workers WHERE order_id=? AND worker_id=?',
+                                         (order_id, actor_id)).fetchone():
+        return 'forbidden'
+    return 'ok' if transition_order(conn, order_id, new_status).rowcount else 'invalid'
+
+async def _refresh_order_card(query, order_id: int) -> Optional[Tuple[str, str, int]]:
+    card = await db_transaction(_order_card_tx, order_id)
+    if card:
+        try:
+            await query.message.edit_text(card[0], reply_markup=build_admin_keyboard_for_order(order_id, card[1]))
+        except BadRequest:
+            pass
+    return card
+
+async def _check_staff_callback(query) -> bool:
+    # callback_data можно подделать из любого чата с ботом: кнопки карточки заказа принимаем
+    # только из админ-чата или от админов
+    if query.message.chat.id == ADMIN_CHAT_ID or is_admin_tg(query.from_user.id):
+        return True
+    logger.warning("Rejected staff callback %r from user %s in chat %s", query.data, query.from_user.id, query.message.chat.id)
+    await query.answer("⛔ Недоступно", show_alert=True)
+    return False
+
+async def take_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: int) -> None:
+    query = update.callback_query
+    if not await _check_staff_callback(query):
+        return
+    worker = query.from_user
+    result = await db_transaction(_take_order_tx, order_id, worker.id, worker.username or '')
+    await query.answer({
+        'taken': f"✅ Вы взяли заказ #{order_id}",
+        'already': "Вы уже в исполнителях этого заказа",
+        'full': f"❌ Уже набрано {MAX_WORKERS_PER_ORDER} исполнителя",
+        'closed': "❌ Заказ недоступен",
+    }[result], show_alert=result != 'taken')
+    if result == 'taken':
+        await _refresh_order_card(query, order_id)
+
+async def leave_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: int) -> None:
+    query = update.callback_query
+    if not await _check_staff_callback(query):
+        return
+    if await db_transaction(_leave_order_tx, order_id, query.from_user.id):
+        await query.answer(f"Вы снялись с заказа #{order_id}")
+        await _refresh_order_card(query, order_id)
+    else:
+        await query.answer("Вы не в исполнителях этого заказа", show_alert=True)
+
+async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: int, new_status: str) -> None:
+    query = update.callback_query
+    if not await _check_staff_callback(query):
+        return
+    if new_status not in ('in_progress', 'done'):
+        await query.answer()
+        return
+    actor = query.from_user
+    result = await db_transaction(_set_order_status_tx, order_id, new_status, actor.id, is_admin_tg(actor.id))
+    if result == 'forbidden':
+        await query.answer("Сначала нажмите «🟢 Беру»", show_alert=True)
+        return
+    if result == 'invalid':
+        await query.answer("Статус уже изменён", show_alert=True)
+        return
+    await query.answer("Статус обновлён")
+    card = await _refresh_order_card(query, order_id)
+    if card and card[2]:
+        if new_status == 'in_progress':
+            notify(card[2], f"▶ Ваш заказ #{order_id} взят в работу.")
+        else:
+            rate_kb = InlineKeyboardMarkup([[InlineKeyboardButton('⭐' * n, callback_data=f'rate:{order_id}:{n}') for n in range(1, 6)]])
+            notify(card[2], f"🏁 Ваш заказ #{order_id} выполнен! Спасибо за покупку.\nОцените работу исполнителей:",
+                   reply_markup=rate_kb)
+
+async def rate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: int, rating: int) -> None:
+    query = update.callback_query
+    if not 1 <= rating <= 5:
+        await query.answer()
+        return
+    if await db_transaction(_add_review_tx, order_id, query.from_user.id, rating):
+        await query.answer("Спасибо за оценку!")
+        try: await query.message.edit_text(f"🏁 Заказ #{order_id} выполнен. Ваша оценка: {'⭐' * rating}")
+        except BadRequest: pass
+    else:
+        await query.answer("Оценка уже учтена", show_alert=True)
+
+async def detail_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: int) -> None:
+    query = update.callback_query
+    if not await _check_staff_callback(query):
+        return
+    await query.answer()
+    card = await db_transaction(_order_card_tx, order_id)
+    await query.message.reply_text(card[0] if card else f"Заказ #{order_id} не найден.")
+
+# --- Menu handlers ---
+async def docs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text('Выберите документ:', reply_markup=DOCS_MENU)
+
+async def user_agreement_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Отправляем ссылку на телеграф
+    await update.message.reply_text(
+        f"📜 *Пользовательское соглашение*\n\nОзнакомиться с документом можно по ссылке:\n{USER_AGREEMENT_URL}",
+        parse_mode='Markdown',
+        disable_web_page_preview=False
+    )
+
+async def privacy_policy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Отправляем ссылку на телеграф
+    await update.message.reply_text(
+        f"🔒 *Политика конфиденциальности*\n\nОзнакомиться с документом можно по ссылке:\n{PRIVACY_POLICY_URL}",
+        parse_mode='Markdown',
+        disable_web_page_preview=False
+    )
+
+async def back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text('Меню', reply_markup=MAIN_MENU)
+
+async def support_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    contact = SUPPORT_CONTACT_USER
+    if not contact.startswith('@') and not contact.startswith('http'): contact = '@' + contact
+    await update.message.reply_text(f'Тех. поддержка: {contact}', reply_markup=MAIN_MENU)
+
+async def my_orders_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    profile = await get_user_profile(user.id)
+    if not profile: return
+    orders = await db_execute('SELECT id, price, status FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 5', (profile['id'],), fetch=True)
+    if not orders: await update.message.reply_text("Нет заказов.")
+    else:
+        msg = "Ваши заказы:\n"
+        for oid, p, s in orders: msg += f"#{oid} - {p}₽ ({ORDER_STATUS_LABELS.get(s, s)})\n"
+        await update.message.reply_text(msg)
+
+async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if is_admin_tg(update.effective_user.id):
+        await update.message.reply_text("Админка", reply_markup=ADMIN_PANEL_KB)
+
+def _refund_order_tx(conn: sqlite3.Connection, order_id: int) -> bool:
+    row = transition_order(conn, order_id, 'refunded', returning='price').fetchall()
+    if row:
+        bump_daily_stats(conn, refunds=1, refunded_amount=row[0][0])
+    return bool(row)
+
+async def refund_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Введите: /refund НОМЕР_ЗАКАЗА")
+        return
+    order_id = int(context.args[0])
+    if await db_transaction(_refund_order_tx, order_id):
+        await update.message.reply_text(f"↩️ Заказ #{order_id} отмечен как возвращённый.")
+    else:
+        await update.message.reply_text(f"❌ Заказ #{order_id} нельзя вернуть из текущего статуса.")
+
+async def settle_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    settled = await settle_done_orders()
+    await update.message.reply_text(f"💸 Рассчитано заказов: {settled}")
+
+async def workers_report_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    rows = await db_execute('SELECT worker_id, worker_username, orders_count, total_earned, rating_sum, rating_count '
+                            'FROM worker_stats ORDER BY total_earned DESC LIMIT 20', fetch=True)
+    if not rows:
+        await update.message.reply_text("Выплат пока нет.")
+        return
+    lines = ["👷 Исполнители (топ-20 по заработку):"]
+    for wid, username, count, earned, rating_sum, rating_count in rows:
+        rating = f"{rating_sum / rating_count:.1f}⭐ ({rating_count})" if rating_count else "—"
+        lines.append(f"{'@' + username if username else wid}: {count} зак., {earned:.2f}₽, {rating}")
+    await update.message.reply_text("\n".join(lines))
+
+async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1] if len(parts) > 1 else (update.message.reply_to_message.text if update.message.reply_to_message else None)
+    if not text:
+        await update.message.reply_text("Использование: /broadcast <текст> (или ответом на сообщение)")
+        return
+    broadcast_id, total = await db_transaction(_create_broadcast_tx, text, update.effective_user.id)
+    broadcast_wakeup.set()
+    await update.message.reply_text(f"📣 Рассылка #{broadcast_id} поставлена в очередь: {total} получателей. "
+                                    f"Отмена: /broadcast_cancel {broadcast_id}")
+
+async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_cancel <id>")
+        return
+    cur = await db_execute("UPDATE broadcasts SET status='cancelled', finished_at=? WHERE id=? AND status='running' "
+                           "RETURNING sent, total", (now_iso(), int(context.args[0])), fetch=True)
+    if cur:
+        await update.message.reply_text(f"⛔ Рассылка остановлена ({cur[0][0]}/{cur[0][1]} отправлено).")
+    else:
+        await update.message.reply_text("Активной рассылки с таким номером нет.")
+
+async def _profile_session(bot, chat_id: int, stop: asyncio.Event, seconds: float) -> None:
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        samples = profiler.stop()
+    folded = "\n".join(f"{stack} {count}" for stack, count in sorted(samples.items(), key=lambda kv: -kv[1]))
+    notify(chat_id, SamplingProfiler.summary(samples))
+    if folded:
+        await bot.send_document(chat_id, document=io.BytesIO(folded.encode('utf-8')), filename=f'profile-{os.getpid()}.folded')
+
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Профилирует процесс, обработавший команду (в режиме вебхука с воркерами — один из шардов)
+    if not is_admin_tg(update.effective_user.id):
+        return
+    if context.args and context.args[0] == 'stop':
+        if profiler.running:
+            context.bot_data['profile_stop'].set()
+        else:
+            await update.message.reply_text("Профилировщик не запущен.")
+        return
+    if profiler.running:
+        await update.message.reply_text("Профилировщик уже запущен. Остановить: /profile stop")
+        return
+    seconds = min(int(context.args[0]), PROFILE_MAX_SECONDS) if context.args and context.args[0].isdigit() else 30
+    stop = context.bot_data['profile_stop'] = asyncio.Event()
+    profiler.start()
+    # Цикл событий держит задачи лишь слабыми ссылками — храним свою, иначе сессию может собрать GC до отчёта
+    context.bot_data['profile_task'] = asyncio.create_task(_profile_session(context.bot, update.effective_chat.id, stop, seconds))
+    await update.message.reply_text(f"🔬 Профилирование на {seconds} с (pid {os.getpid()}). Остановить: /profile stop")
+
+async def admin_orders_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    rows, cursor = await list_orders()
+    text, kb = render_orders_page(rows, None, cursor)
+    await update.message.reply_text(text, reply_markup=kb)
+
+async def admin_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, status: str, cursor: int) -> None:
+    query = update.callback_query
+    await query.answer()
+    if not is_admin_tg(query.from_user.id):
+        return
+    status = status if status in ADMIN_ORDER_FILTERS else None
+    rows, next_cursor = await list_orders(status, cursor or None)
+    text, kb = render_orders_page(rows, status, next_cursor)
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except BadRequest:
+        pass
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_tg(update.effective_user.id):
+        return
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 7
+    await update.message.reply_text(render_stats(await stats_summary(min(max(days, 1), 366))))
+
+# --- Routing ---
+# Кнопки меню: текст -> хендлер (один поиск в dict вместо цепочки if/elif)
+MENU_ROUTES: Dict[str, Callable] = {
+    '💰 Баланс': balance_handler,
+    '📦 Каталог': products_handler,
+    '🎮 Привязать PUBG ID': pubg_bind_handler,
+    '🧾 Мои заказы': my_orders_handler,
+    '📞 Поддержка': support_handler,
+    '📄 Документы': docs_handler,
+    '📜 Пользовательское соглашение': user_agreement_handler,
+    '🔒 Политика конфиденциальности': privacy_policy_handler,
+    '↩️ Назад': back_handler,
+}
+ADMIN_MENU_ROUTES: Dict[str, Callable] = {
+    '📋 Список заказов': admin_orders_handler,
+    '📊 Статистика': stats_handler,
+}
+
+# Inline-кнопки: префикс callback_data -> (хендлер, типы аргументов после префикса)
+CALLBACK_ROUTES: Dict[str, Tuple[Callable, Tuple[type, ...]]] = {
+    'buy': (buy_callback, (int,)),
+    'cat': (catalog_callback, (int,)),
+    'take': (take_callback, (int,)),
+    'leave': (leave_callback, (int,)),
+    'status': (status_callback, (int, str)),
+    'detail_order': (detail_order_callback, (int,)),
+    'rate': (rate_callback, (int, int)),
+    'orders': (admin_orders_callback, (str, int)),
+}
 
 async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
     
-    # === ОСНОВНОЕ МЕНЮ ===
-    if text == '💰 Баланс': 
-        await balance_handler(update, context)
-        
-    elif text == '📦 Каталог': 
-        await products_handler(update, context)
-        
-    elif text == '📄 Документы': 
-        await update.message.reply_text('Выберите документ:', reply_markup=DOCS_MENU)
-
-    # === ОБНОВЛЕННАЯ ЛОГИКА ДОКУМЕНТОВ ===
-    elif text == '📜 Пользовательское соглашение': 
-        # Отправляем ссылку на телеграф
-        await update.message.reply_text(
-            f"📜 *Пользовательское соглашение*\n\nОзнакомиться с документом можно по ссылке:\n{USER_AGREEMENT_URL}",
-            parse_mode='Markdown',
-            disable_web_page_preview=False 
-        )
-        
-    elif text == '🔒 Политика конфиденциальности': 
-        # Отправляем ссылку на телеграф
-        await update.message.reply_text(
-            f"🔒 *Политика конфиденциальности*\n\nОзнакомиться с документом можно по ссылке:\n{PRIVACY_POLICY_URL}",
-            parse_mode='Markdown',
-            disable_web_page_preview=False
-        )
-    # ======================================
-
-    elif text == '↩️ Назад': 
-        await update.message.reply_text('Меню', reply_markup=MAIN_MENU)
-        
-    elif text == '📞 Поддержка':
-        contact = SUPPORT_CONTACT_USER
-        if not contact.startswith('@') and not contact.startswith('http'): contact = '@' + contact
-        await update.message.reply_text(f'Тех. поддержка: {contact}', reply_markup=MAIN_MENU)
-        
-    elif text == '🧾 Мои заказы':
-        user = update.effective_user
-        uid_row = db_execute('SELECT id FROM users WHERE tg_id=?', (user.id,), fetch=True)
-        if not uid_row: return
-        uid = uid_row[0][0]
-        orders = db_execute('SELECT id, price, status FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 5', (uid,), fetch=True)
-        if not orders: await update.message.reply_text("Нет заказов.")
+    if context.user_data.get('awaiting_pubg'):
+        if text == '↩️ Назад':
+            context.user_data.pop('awaiting_pubg', None)
         else:
-            msg = "Ваши заказы:\n"
-            for oid, p, s in orders: msg += f"#{oid} - {p}₽ ({s})\n"
-            await update.message.reply_text(msg)
-            
-    # Admin commands (simple)
-    elif text == '/admin' and is_admin_tg(update.effective_user.id):
-        await update.message.reply_text("Админка", reply_markup=ADMIN_PANEL_KB)
-    elif text == '📋 Список заказов' and is_admin_tg(update.effective_user.id):
-         # logic for listing orders
-         await update.message.reply_text("Используйте веб-интерфейс или базу данных для полного списка.")
+            await call_handler(pubg_id_input, update, context)
+            return
+    
+    handler = MENU_ROUTES.get(text)
+    if handler is None and is_admin_tg(update.effective_user.id):
+        handler = ADMIN_MENU_ROUTES.get(text)
+    if handler is not None:
+        await call_handler(handler, update, context)
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    prefix, *raw_args = query.data.split(':')
+    route = CALLBACK_ROUTES.get(prefix)
+    # Неизвестный префикс (в т.ч. 'noop' у индикатора страницы) — только снимаем "часики"
+    if route is None or len(raw_args) != len(route[1]):
+        await query.answer()
+        return
+    handler, types = route
+    try:
+        args = [t(v) for t, v in zip(types, raw_args)]
+    except ValueError:
+        await query.answer()
+        return
+    await call_handler(handler, update, context, *args)
+
+# --- Update scheduling ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently, one chat's updates strictly in order."""
+
+    # Семафор базового класса берётся до do_process_update, поэтому ждущие своей очереди апдейты
+    # одного чата занимали бы его слоты. Он остаётся лишь страховкой, лимит — свой семафор после блокировки чата
+    BACKSTOP_LIMIT = 1 << 16
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max(max_concurrent_updates, self.BACKSTOP_LIMIT))
+        self._limit = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_depth: Dict[int, int] = {}
+        # Ошибки хендлеров сюда не доходят (Application.process_update их перехватывает) — они в bot_handler_errors_total
+        self.stats = {'processed': 0, 'timeouts': 0, 'queued': 0, 'max_chat_depth': 0}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Сначала очередь чата, потом общий лимит: ожидающие апдейты одного чата не занимают слоты
+        key = self._chat_key(update)
+        if key is None:
+            async with self._limit:
+                await self._run(coroutine)
+            return
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        depth = self._chat_depth[key] = self._chat_depth.get(key, 0) + 1
+        self.stats['max_chat_depth'] = max(self.stats['max_chat_depth'], depth)
+        self.stats['queued'] += 1
+        queued = True
+        try:
+            async with lock:
+                self.stats['queued'] -= 1
+                queued = False
+                async with self._limit:
+                    await self._run(coroutine)
+        finally:
+            if queued:  # отменён, не дождавшись очереди
+                self.stats['queued'] -= 1
+            self._chat_depth[key] -= 1
+            if not self._chat_depth[key]:
+                del self._chat_depth[key]
+                del self._chat_locks[key]
+
+    async def _run(self, coroutine) -> None:
+        try:
+            await asyncio.wait_for(coroutine, HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            logger.warning(f"Update handling timed out after {HANDLER_TIMEOUT}s")
+        finally:
+            self.stats['processed'] += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 # --- MAIN EXECUTION ---
-async def run_bot_and_webserver():
-    init_db()
-    
-    app = ApplicationBuilder().token(TG_BOT_TOKEN).build()
+def build_application(with_updater: bool = True):
+    processor = PerChatUpdateProcessor(UPDATE_CONCURRENCY)
+    metrics.add_collector(lambda: [(f'updates_{k}_total' if k in ('processed', 'timeouts') else f'updates_{k}', {}, v)
+                                   for k, v in processor.stats.items()])
+    builder = (ApplicationBuilder().token(TG_BOT_TOKEN).base_url(TG_API_URL)
+               .request(InstrumentedRequest(connection_pool_size=256))
+               .concurrent_updates(processor))
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
     
-    app.add_handler(CommandHandler('start', start))
-    app.add_handler(CommandHandler('promo', promo_handler))
-    app.add_handler(CommandHandler('balance', balance_handler))
+    app.add_handler(CommandHandler('start', instrumented(start)))
+    app.add_handler(CommandHandler('promo', instrumented(promo_handler)))
+    app.add_handler(CommandHandler('balance', instrumented(balance_handler)))
+    app.add_handler(CommandHandler('admin', instrumented(admin_handler)))
+    app.add_handler(CommandHandler('refund', instrumented(refund_handler)))
+    app.add_handler(CommandHandler('settle', instrumented(settle_handler)))
+    app.add_handler(CommandHandler('workers', instrumented(workers_report_handler)))
+    app.add_handler(CommandHandler('stats', instrumented(stats_handler)))
+    app.add_handler(CommandHandler('broadcast', instrumented(broadcast_handler)))
+    app.add_handler(CommandHandler('broadcast_cancel', instrumented(broadcast_cancel_handler)))
+    app.add_handler(CommandHandler('profile', instrumented(profile_handler)))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
-    app.add_handler(CallbackQueryHandler(buy_callback, pattern=r'^buy:'))
-    
+    app.add_handler(CallbackQueryHandler(callback_router))
+    return app
+
+# --- Telegram webhook mode ---
+# Апдейты шардируются по id пользователя: все апдейты одного пользователя попадают
+# в один процесс и обрабатываются по порядку. Общее состояние — SQLite (WAL).
+tg_app = None
+update_shards: list = []
+update_workers: list = []
+update_relay = None  # очередь шарды -> основной процесс (уведомления, инвалидация кэша)
+worker_relay = None  # то же изнутри процесса-шарда
+_worker_restarted_at: Dict[int, float] = {}
+
+class RelayOutbox:
+    """Outbox of a shard process: messages go to the main process, whose single OutboundQueue keeps the bot-wide limits."""
+
+    def __init__(self, relay):
+        self.relay = relay
+
+    def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        self.relay.put(('notify', chat_id, text, kwargs))
+        return True
+
+    async def close(self, timeout: float = 10) -> None:
+        self.relay.close()
+        await asyncio.get_running_loop().run_in_executor(None, self.relay.join_thread)
+
+def bump_user_cache(tg_id: int, field: str, delta: float) -> None:
+    # Профиль другого пользователя может лежать в кэше другого шарда: туда уходит инвалидация
+    if worker_relay is not None:
+        worker_relay.put(('invalidate', tg_id))
+    elif update_shards:
+        update_shards[abs(tg_id) % len(update_shards)].put(('invalidate', tg_id))
+    else:
+        user_cache.add(tg_id, field, delta)
+
+async def relay_consumer(relay) -> None:
+    """Main process side of RelayOutbox and bump_user_cache; stops on None once the workers are gone."""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, relay.get)
+        if item is None:
+            return
+        if item[0] == 'notify':
+            _, chat_id, text, kwargs = item
+            notify(chat_id, text, **kwargs)
+        elif item[0] == 'invalidate' and update_shards:
+            update_shards[abs(item[1]) % len(update_shards)].put(item)
+
+def update_shard_key(data: dict) -> int:
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user') or value.get('chat')
+            if isinstance(user, dict) and 'id' in user:
+                return abs(int(user['id']))
+    return int(data.get('update_id', 0))
+
+async def handle_telegram_update(request):
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if TG_WEBHOOK_SECRET and not hmac.compare_digest(secret, TG_WEBHOOK_SECRET):
+        return web.Response(status=403, text="Forbidden")
+    body = await request.read()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return web.Response(status=400, text="Bad payload")
+    if update_shards:
+        shard = update_shard_key(data) % len(update_shards)
+        if not ensure_update_worker(shard):
+            return web.Response(status=503, text="Worker restarting")
+        update_shards[shard].put(body)
+    elif tg_app is not None:
+        await tg_app.update_queue.put(Update.de_json(data, tg_app.bot))
+    else:
+        return web.Response(status=503, text="Starting")
+    return web.Response(text="OK")
+
+def run_update_worker(shard: int, queue, relay) -> None:
+    try:
+        asyncio.run(_update_worker_main(shard, queue, relay))
+    except KeyboardInterrupt:
+        pass
+
+async def _update_worker_main(shard: int, queue, relay) -> None:
+    global outbox, worker_relay
+    app = build_application(with_updater=False)
     await app.initialize()
     await app.start()
+    worker_relay = relay
+    outbox = RelayOutbox(relay)
+    loop = asyncio.get_running_loop()
+    runner = None
+    if WORKER_METRICS_PORT:
+        # Метрики шардов живут в своих процессах — каждый отдаёт их на своём порту
+        server = web.Application()
+        server.router.add_get('/metrics', handle_metrics)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', WORKER_METRICS_PORT + shard).start()
+    logger.info(f"Update worker {shard} started (pid {os.getpid()})")
+    try:
+        while True:
+            body = await loop.run_in_executor(None, queue.get)
+            if body is None:
+                break
+            if isinstance(body, tuple):
+                user_cache.invalidate(body[1])
+                continue
+            await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await outbox.close()
+        await lava.close()
+        await app.stop()
+        await app.shutdown()
+        close_db()
+
+def _spawn_update_worker(shard: int, queue, relay):
+    proc = multiprocessing.get_context('spawn').Process(target=run_update_worker, args=(shard, queue, relay),
+                                                        name=f'update-worker-{shard}', daemon=True)
+    proc.start()
+    return proc
+
+def start_update_workers(count: int) -> list:
+    global update_relay
+    ctx = multiprocessing.get_context('spawn')
+    update_relay = ctx.Queue()
+    for shard in range(count):
+        queue = ctx.Queue()
+        update_shards.append(queue)
+        update_workers.append(_spawn_update_worker(shard, queue, update_relay))
+    return update_workers
+
+def ensure_update_worker(shard: int) -> bool:
+    """Restarts a dead shard process; False while it keeps dying (the caller answers 503 and Telegram retries)."""
+    proc = update_workers[shard]
+    if proc.is_alive():
+        return True
+    now = time.monotonic()
+    if now - _worker_restarted_at.get(shard, -WORKER_RESTART_BACKOFF) < WORKER_RESTART_BACKOFF:
+        return False
+    # Очередь берём новую: убитый процесс мог умереть, держа её блокировку чтения, и тогда
+    # новый не получил бы ничего. Апдейты, которые он не успел забрать, теряются (Telegram уже получил 200)
+    logger.error(f"Update worker {shard} died (exit code {proc.exitcode}), restarting with a fresh queue")
+    metrics.inc('update_worker_restarts_total', shard=str(shard))
+    _worker_restarted_at[shard] = now
+    old = update_shards[shard]
+    old.cancel_join_thread()
+    old.close()
+    update_shards[shard] = multiprocessing.get_context('spawn').Queue()
+    update_workers[shard] = _spawn_update_worker(shard, update_shards[shard], update_relay)
+    return True
+
+def stop_update_workers(workers: list, timeout: float = 15) -> None:
+    for queue in update_shards:
+        queue.put(None)
+    for proc in workers:
+        proc.join(timeout)
+        if proc.is_alive():
+            proc.terminate()
+    update_shards.clear()
+    update_workers.clear()
+
+async def run_bot_and_webserver():
+    global outbox, tg_app
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass  # Windows
+    init_db()
+    webhook_mode = BOT_MODE == 'webhook'
+    workers = start_update_workers(BOT_WORKERS) if webhook_mode and BOT_WORKERS > 0 else []
     
+    # HTTP-сервер поднимается до инициализации Telegram: платёжные вебхуки сразу ложатся в inbox,
+    # апдейты уходят в шарды (или получают 503, и Telegram повторит доставку)
     server = web.Application()
     server.router.add_post('/lava_webhook', handle_lava_webhook)
+    server.router.add_post('/webhook/{provider}', handle_payment_webhook)
+    server.router.add_get('/admin/orders', handle_admin_orders)
+    server.router.add_get('/admin/stats', handle_admin_stats)
+    server.router.add_get('/metrics', handle_metrics)
+    if webhook_mode:
+        server.router.add_post(TG_WEBHOOK_PATH, handle_telegram_update)
     runner = web.AppRunner(server)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', WEBHOOK_PORT)
     await site.start()
     
-    print(f"🚀 Bot started. Webhook listening on port {WEBHOOK_PORT}")
-    
-    await app.updater.start_polling()
-    
+    app = None
+    tasks: List[asyncio.Task] = []
+    relay_task = None
     try:
+        app = build_application(with_updater=not webhook_mode)
+        await app.initialize()
+        await app.start()
+        tg_app = app
+        # Вебхуки и хендлеры шлют уведомления через один общий бот
+        outbox = OutboundQueue(app.bot)
+        
+        print(f"🚀 Bot started ({BOT_MODE}, workers: {len(workers)}). Webhook listening on port {WEBHOOK_PORT}")
+        
+        if webhook_mode:
+            await app.bot.set_webhook(f"{WEBHOOK_HOST}{TG_WEBHOOK_PATH}", secret_token=TG_WEBHOOK_SECRET or None,
+                                      allowed_updates=Update.ALL_TYPES)
+        else:
+            await app.updater.start_polling()
+        tasks = [asyncio.create_task(order_expiry_sweeper()),
+                 asyncio.create_task(inbox_consumer()),
+                 asyncio.create_task(settlement_worker()),
+                 asyncio.create_task(broadcast_worker(app.bot))]
+        if workers:
+            relay_task = asyncio.create_task(relay_consumer(update_relay))
         while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
-        await app.updater.stop()
-        await app.stop()
-        await app.shutdown()
+            await asyncio.sleep(WORKER_RESTART_BACKOFF)
+            # Упавший шард перезапускается и без новых апдейтов: в его очереди могут лежать принятые
+            for shard in range(len(update_workers)):
+                ensure_update_worker(shard)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
         await runner.cleanup()
+        if app is not None and app.updater and app.updater.running:
+            await app.updater.stop()
+        stop_update_workers(workers)
+        if update_relay is not None:
+            # Шарды остановлены: досылаем их последние уведомления и отпускаем поток с relay.get()
+            update_relay.put(None)
+            if relay_task is not None:
+                await relay_task
+        if outbox is not None:
+            await outbox.close()
+        await lava.close()
+        if app is not None:
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+        close_db()
+
+def validate_config() -> List[str]:
+    problems = list(CONFIG_ERRORS)
+    if not re.fullmatch(r'\d+:[\w-]+', TG_BOT_TOKEN):
+        problems.append("TG_BOT_TOKEN: неверный формат токена")
+    if BOT_MODE not in ('polling', 'webhook'):
+        problems.append(f"BOT_MODE: ожидается polling или webhook, получено {BOT_MODE!r}")
+    if BOT_MODE == 'webhook' and 'YOUR_SERVER_IP' in WEBHOOK_HOST:
+        problems.append("WEBHOOK_HOST: не задан адрес сервера для режима webhook")
+    if BOT_WORKERS < 0 or (BOT_WORKERS and BOT_MODE != 'webhook'):
+        problems.append("BOT_WORKERS: процессы-обработчики работают только в режиме webhook")
+    if not 1 <= WEBHOOK_PORT <= 65535:
+        problems.append(f"WEBHOOK_PORT: недопустимый порт {WEBHOOK_PORT}")
+    db_dir = os.path.dirname(os.path.abspath(DB_PATH))
+    if not os.path.isdir(db_dir):
+        problems.append(f"DB_PATH: каталог {db_dir} не существует")
+    if LAVA_PROJECT_ID == 'YOUR_LAVA_PROJECT_ID_HERE':
+        logger.warning("LAVA_PROJECT_ID is not set, purchases are disabled")
+    return problems
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Metro Shop bot")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('run', help="запустить бота и вебхук-сервер (по умолчанию)")
+    p = sub.add_parser('import-catalog', help="синхронизировать товары из items.json / .jsonl")
+    p.add_argument('path')
+    p = sub.add_parser('export-catalog', help="выгрузить товары в формате items.json / .jsonl")
+    p.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'import-catalog':
+        init_db()
+        print(import_catalog(args.path))
+    elif args.command == 'export-catalog':
+        init_db()
+        print(f"Exported {export_catalog(args.path)} products")
+    else:
+        problems = validate_config()
+        if problems:
+            parser.exit(2, "Ошибки конфигурации:\n" + "\n".join(f"  - {p}" for p in problems) + "\n")
+        try:
+            asyncio.run(run_bot_and_webserver())
+        except KeyboardInterrupt:
+            pass
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(run_bot_and_webserver())
-    except KeyboardInterrupt:
-        pass
+    main()
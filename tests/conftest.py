@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LAVA_PROJECT_ID', 'test')
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Fresh migrated database; the pool is torn down afterwards so each test gets its own connections."""
+    path = str(tmp_path / 'test.db')
+    monkeypatch.setattr(bot, 'DB_PATH', path)
+    bot.user_cache._data.clear()
+    bot.catalog.invalidate()
+    bot.init_db()
+    yield path
+    bot.close_db()
+
+
+def seed_users(count: int, invited_by=None) -> None:
+    conn = bot._db_connect()
+    conn.executemany('INSERT INTO users (tg_id, username, registered_at, balance, invited_by) VALUES (?, ?, ?, 0, ?)',
+                     [(tg_id, f'u{tg_id}', bot.now_iso(), invited_by) for tg_id in range(1, count + 1)])
+    conn.close()
+
+
+def seed_product(price: float = 100) -> int:
+    conn = bot._db_connect()
+    pid = conn.execute('INSERT INTO products (name, price) VALUES (?, ?)', ('Товар', price)).lastrowid
+    conn.close()
+    return pid
@@ -0,0 +1,39 @@
+import asyncio
+from collections import Counter
+
+from telegram.error import ChatMigrated, Forbidden
+
+import bot
+from conftest import seed_users
+
+USERS = 50
+
+
+class FlakyBot:
+    def __init__(self):
+        self.calls = Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls[chat_id] += 1
+        if chat_id == 7:
+            raise ChatMigrated(-1007)
+        if chat_id == 8:
+            raise ValueError('unexpected')
+        if chat_id == 9:
+            raise Forbidden('bot was blocked by the user')
+
+
+def test_one_recipient_error_does_not_resend_the_chunk(db, monkeypatch):
+    monkeypatch.setattr(bot, 'notify', lambda *args, **kwargs: None)
+    seed_users(USERS)
+    conn = bot._db_connect()
+    broadcast_id = conn.execute("INSERT INTO broadcasts (text, status, total, created_at) VALUES ('hi', 'running', ?, ?)",
+                                (USERS, bot.now_iso())).lastrowid
+    fake = FlakyBot()
+    result = asyncio.run(bot.BroadcastEngine(fake, rate=100000, senders=8).run(broadcast_id))
+
+    assert result == 'done'
+    assert set(fake.calls) == set(range(1, USERS + 1)) and set(fake.calls.values()) == {1}
+    assert conn.execute('SELECT status, sent, failed, blocked FROM broadcasts WHERE id=?', (broadcast_id,)).fetchone() == \
+        ('done', USERS - 3, 2, 1)
+    conn.close()
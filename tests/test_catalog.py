@@ -0,0 +1,91 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import bot
+
+ids = itertools.count(100)
+
+
+class FakeMessage:
+    def __init__(self, log, chat_id=42):
+        self.log, self.chat_id, self.message_id = log, chat_id, next(ids)
+
+    async def reply_photo(self, photo, caption=None):
+        self.log.append(('photo', photo))
+        return FakeMessage(self.log)
+
+    async def reply_media_group(self, media):
+        self.log.append(('album', len(media)))
+        return tuple(FakeMessage(self.log) for _ in media)
+
+    async def reply_text(self, text, reply_markup=None):
+        self.log.append(('text', text.splitlines()[0]))
+        return FakeMessage(self.log)
+
+    async def edit_text(self, text, reply_markup=None):
+        self.log.append(('edit', text.splitlines()[0]))
+
+    async def delete(self):
+        self.log.append(('delete', self.message_id))
+
+
+class FakeBot:
+    def __init__(self, log):
+        self.log = log
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.log.append(('delete_album', list(message_ids)))
+
+
+class FakeQuery:
+    def __init__(self, log, data):
+        self.data, self.message = data, FakeMessage(log)
+        self.answered = 0
+
+    async def answer(self):
+        self.answered += 1
+
+
+def items(pages: int, photos: bool):
+    count = pages * bot.CATALOG_PAGE_SIZE
+    return [(i, f'p{i}', 100, f'photo{i}' if photos else None) for i in range(count)]
+
+
+def test_page_indicator_is_noop():
+    _, kb, _ = bot.render_catalog_page(items(3, photos=False), 1)
+    nav = kb.inline_keyboard[-1]
+    assert [b.callback_data for b in nav] == ['cat:0', 'noop', 'cat:2']
+
+    log = []
+    query = FakeQuery(log, 'noop')
+    asyncio.run(bot.callback_router(SimpleNamespace(callback_query=query), SimpleNamespace(user_data={})))
+    assert query.answered == 1 and log == []
+
+
+def test_paging_deletes_previous_album(monkeypatch):
+    prods = items(3, photos=True)
+
+    async def cached_items():
+        return prods
+    monkeypatch.setattr(bot.catalog, 'items', cached_items)
+
+    log = []
+    context = SimpleNamespace(user_data={}, bot=FakeBot(log))
+    asyncio.run(bot.send_catalog_page(FakeMessage(log), prods, 0, context))
+    first_album = context.user_data['catalog_album']
+    assert len(first_album) == bot.CATALOG_PAGE_SIZE
+
+    query = FakeQuery(log, 'cat:1')
+    asyncio.run(bot.catalog_callback(SimpleNamespace(callback_query=query), context, 1))
+    assert ('delete_album', first_album) in log
+    assert ('delete', query.message.message_id) in log
+    assert context.user_data['catalog_album'] != first_album
+
+    # Страница без фото: старый альбом убирается, список редактируется на месте
+    log.clear()
+    prods[:] = items(3, photos=False)
+    second_album = context.user_data['catalog_album']
+    asyncio.run(bot.catalog_callback(SimpleNamespace(callback_query=FakeQuery(log, 'cat:2')), context, 2))
+    assert log == [('delete_album', second_album), ('edit', '📦 Каталог (стр. 3/3):')]
+    assert 'catalog_album' not in context.user_data
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_reimport_of_loosely_typed_items_is_unchanged(db, tmp_path):
+    items = [
+        {'id': 1, 'name': 'UC 60', 'price': '99', 'stock': '5', 'old_price': 120, 'category': 'uc', 'extra': {'b': 1, 'a': 2}},
+        {'id': 'x2', 'name': 300, 'price': 10.5, 'stock': 3.0, 'desc': 'Набор', 'photo': '', 'currency': None},
+        {'id': 3, 'name': 'Пропуск', 'price': 500, 'stock': None, 'delivery_text': 'Код придёт в чат'},
+    ]
+    path = tmp_path / 'items.json'
+    path.write_text(json.dumps(items, ensure_ascii=False), encoding='utf-8')
+
+    assert bot.import_catalog(str(path)) == {'total': 3, 'inserted': 3, 'updated': 0, 'unchanged': 0}
+    assert bot.import_catalog(str(path)) == {'total': 3, 'inserted': 0, 'updated': 0, 'unchanged': 3}
+
+    items[0]['stock'] = '4'
+    path.write_text(json.dumps(items, ensure_ascii=False), encoding='utf-8')
+    assert bot.import_catalog(str(path)) == {'total': 3, 'inserted': 0, 'updated': 1, 'unchanged': 2}
+
+    conn = bot._db_connect()
+    assert conn.execute("SELECT stock, price FROM products WHERE sku='1'").fetchone() == (4, 99.0)
+    conn.close()
+
+
+def test_running_bot_sees_import_from_cli_process(db, tmp_path):
+    path = tmp_path / 'items.json'
+    path.write_text(json.dumps([{'id': 'uc60', 'name': 'UC 60', 'price': 99}]), encoding='utf-8')
+    bot.import_catalog(str(path))
+
+    async def price():
+        return [p[2] for p in await bot.catalog.items()]
+    assert asyncio.run(price()) == [99.0]
+
+    # Импорт идёт отдельным процессом — invalidate() кэша бота он вызвать не может
+    path.write_text(json.dumps([{'id': 'uc60', 'name': 'UC 60', 'price': 149}]), encoding='utf-8')
+    subprocess.run([sys.executable, 'bot.py', 'import-catalog', str(path)], cwd=ROOT, check=True, timeout=60,
+                   env=dict(os.environ, DB_PATH=db), capture_output=True)
+    assert asyncio.run(price()) == [149.0]
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+import bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_malformed_numbers_are_reported_not_raised():
+    # Импорт с кривыми числами не должен падать с ValueError — ошибки собирает validate_config
+    env = dict(os.environ, OWNER_ID='me', WEBHOOK_PORT='80 80', HANDLER_TIMEOUT='1m', BOT_WORKERS='2')
+    code = "import bot; print(bot.OWNER_ID == 8473513085, bot.BOT_WORKERS); print(*bot.validate_config(), sep='\\n')"
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.splitlines()
+    assert lines[0] == 'True 2'
+    problems = lines[1:]
+    assert any(p.startswith('OWNER_ID:') and "'me'" in p for p in problems)
+    assert any(p.startswith('WEBHOOK_PORT:') for p in problems)
+    assert any(p.startswith('HANDLER_TIMEOUT:') for p in problems)
+    assert not any(p.startswith('BOT_WORKERS: ожидается') for p in problems)
+
+
+def test_env_number_falls_back_to_default(monkeypatch):
+    monkeypatch.setattr(bot, 'CONFIG_ERRORS', [])
+    monkeypatch.setenv('BROADCAST_RATE', 'fast')
+    assert bot._env_number('BROADCAST_RATE', '15', float) == 15.0
+    monkeypatch.setenv('BROADCAST_RATE', '7.5')
+    assert bot._env_number('BROADCAST_RATE', '15', float) == 7.5
+    assert len(bot.CONFIG_ERRORS) == 1
@@ -0,0 +1,45 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+
+
+def test_failed_commit_rolls_back(db, monkeypatch):
+    # Один поток в пуле — PRAGMA и транзакции гарантированно идут через одно соединение
+    monkeypatch.setattr(bot, 'DB_POOL_SIZE', 1)
+
+    def orphan_child(conn):
+        conn.execute('INSERT INTO child (parent_id) VALUES (42)')
+
+    def add_parent(conn):
+        conn.execute('INSERT INTO parent (id) VALUES (1)')
+
+    async def scenario():
+        await bot.db_execute('PRAGMA foreign_keys=ON')
+        await bot.db_execute('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+        await bot.db_execute('CREATE TABLE child (parent_id INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)')
+        # Нарушение отложенного внешнего ключа обнаруживается только на COMMIT
+        with pytest.raises(sqlite3.IntegrityError):
+            await bot.db_transaction(orphan_child)
+        await bot.db_transaction(add_parent)
+        return await bot.db_execute('SELECT COUNT(*) FROM parent', fetch=True), \
+            await bot.db_execute('SELECT COUNT(*) FROM child', fetch=True)
+
+    parents, children = asyncio.run(scenario())
+    assert parents[0][0] == 1
+    assert children[0][0] == 0
+
+
+def test_concurrent_transactions_are_serialized(db):
+    def bump(conn):
+        value = conn.execute('SELECT balance FROM users WHERE tg_id=1').fetchone()[0]
+        conn.execute('UPDATE users SET balance=? WHERE tg_id=1', (value + 1,))
+
+    async def scenario():
+        await bot.db_execute("INSERT INTO users (tg_id, registered_at, balance) VALUES (1, '', 0)")
+        await asyncio.gather(*(bot.db_transaction(bump) for _ in range(500)))
+        return await bot.db_execute('SELECT balance FROM users WHERE tg_id=1', fetch=True)
+
+    assert asyncio.run(scenario())[0][0] == 500
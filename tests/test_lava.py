@@ -0,0 +1,150 @@
+import asyncio
+import socket
+
+import pytest
+from aiohttp import web
+
+import bot
+
+
+class StubLava:
+    """Local stand-in for api.lava.ru: counts hits, answers according to `mode`."""
+
+    def __init__(self):
+        self.mode = 'ok'
+        self.hits = 0
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        await request.read()
+        self.hits += 1
+        if self.mode == 'error':
+            return web.Response(status=502)
+        if self.mode == 'slow':
+            await asyncio.sleep(1)
+        return web.json_response({'data': {'id': f'inv{self.hits}', 'url': 'https://pay.example/x'}})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/business/invoice/create', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    monkeypatch.setattr(bot.random, 'uniform', lambda a, b: 0)
+    monkeypatch.setattr(bot, 'LAVA_READ_TIMEOUT', 0.2)
+    monkeypatch.setattr(bot, 'LAVA_CONNECT_TIMEOUT', 0.5)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_success():
+    async def scenario():
+        async with StubLava() as stub:
+            client = bot.LavaClient(stub.url)
+            result = await client.post('/business/invoice/create', {'sum': 100})
+            await client.close()
+            return stub.hits, result
+    hits, result = run(scenario)
+    assert hits == 1
+    assert result['data']['id'] == 'inv1'
+
+
+@pytest.mark.parametrize('mode', ['error', 'slow'])
+def test_sent_request_is_not_retried(mode):
+    # 5xx и таймаут чтения: сервер мог уже создать счёт, повтор создал бы второй
+    async def scenario():
+        async with StubLava() as stub:
+            stub.mode = mode
+            client = bot.LavaClient(stub.url)
+            with pytest.raises(bot.LavaError):
+                await client.post('/business/invoice/create', {'sum': 100})
+            await client.close()
+            return stub.hits, client
+    hits, client = run(scenario)
+    assert hits == 1
+    assert client.stats['requests'] == 1
+    assert client.stats['errors'] == 1
+
+
+def test_connect_failure_is_retried():
+    async def scenario():
+        client = bot.LavaClient(f'http://127.0.0.1:{free_port()}')
+        with pytest.raises(bot.LavaError):
+            await client.post('/business/invoice/create', {'sum': 100})
+        await client.close()
+        return client
+    client = run(scenario)
+    assert client.stats['requests'] == bot.LAVA_RETRIES + 1
+
+
+def test_breaker_opens_and_half_opens():
+    async def scenario():
+        async with StubLava() as stub:
+            stub.mode = 'error'
+            client = bot.LavaClient(stub.url)
+            for _ in range(bot.LAVA_BREAKER_THRESHOLD):
+                with pytest.raises(bot.LavaError):
+                    await client.post('/business/invoice/create', {'sum': 100})
+            assert stub.hits == bot.LAVA_BREAKER_THRESHOLD
+
+            # Разомкнут: запросы отклоняются, не доходя до сервера
+            with pytest.raises(bot.LavaError, match='circuit open'):
+                await client.post('/business/invoice/create', {'sum': 100})
+            assert stub.hits == bot.LAVA_BREAKER_THRESHOLD
+            assert client.stats['rejected'] == 1
+
+            # После паузы пробный запрос проходит; неудачный снова размыкает
+            client.breaker.cooldown = 0.05
+            await asyncio.sleep(0.06)
+            with pytest.raises(bot.LavaError, match='HTTP 502'):
+                await client.post('/business/invoice/create', {'sum': 100})
+            with pytest.raises(bot.LavaError, match='circuit open'):
+                await client.post('/business/invoice/create', {'sum': 100})
+
+            # Удачный пробный запрос замыкает
+            stub.mode = 'ok'
+            await asyncio.sleep(0.06)
+            await client.post('/business/invoice/create', {'sum': 100})
+            assert client.breaker.opened_at is None and client.breaker.failures == 0
+            await client.post('/business/invoice/create', {'sum': 100})
+            await client.close()
+            return stub.hits
+    assert run(scenario) == bot.LAVA_BREAKER_THRESHOLD + 3
+
+
+def test_half_open_lets_one_probe_through(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: clock[0])
+    breaker = bot.CircuitBreaker(threshold=2, cooldown=30)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    clock[0] += 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert not breaker.allow()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.allow() and breaker.allow()
@@ -0,0 +1,66 @@
+import os
+import shutil
+
+import bot
+
+LEGACY_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metro_shop.db')
+
+
+def test_legacy_database_upgrades_to_reachable_states(tmp_path, monkeypatch):
+    path = str(tmp_path / 'legacy.db')
+    shutil.copy(LEGACY_DB, path)
+    monkeypatch.setattr(bot, 'DB_PATH', path)
+    bot.init_db()
+
+    conn = bot._db_connect()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(bot.MIGRATIONS)
+    statuses = dict(conn.execute('SELECT status, COUNT(*) FROM orders GROUP BY status').fetchall())
+    conn.close()
+    # Каждый статус либо известен жизненному циклу заказа, либо из него есть переход
+    known = set(bot.ORDER_STATUS_LABELS)
+    assert set(statuses) <= known, statuses
+    assert statuses['expired'] == 14
+    assert all(s in ('expired', 'refunded') or any(s in sources for sources in bot.ORDER_TRANSITIONS.values())
+               for s in statuses)
+
+
+def test_migrations_are_idempotent_on_fresh_database(db):
+    conn = bot._db_connect()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    bot.close_db()
+    bot.init_db()
+    conn = bot._db_connect()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == version == len(bot.MIGRATIONS)
+    conn.close()
+
+
+def test_concurrent_start_does_not_rerun_applied_migrations(tmp_path, monkeypatch):
+    path = str(tmp_path / 'legacy.db')
+    shutil.copy(LEGACY_DB, path)
+    monkeypatch.setattr(bot, 'DB_PATH', path)
+    runs = []
+
+    def counted(number, migrate):
+        def run(cur):
+            runs.append(number)
+            migrate(cur)
+        return run
+
+    class RacingMigrations(list):
+        raced = False
+
+        def __getitem__(self, item):
+            # Второй экземпляр успевает мигрировать базу между чтением user_version и первой миграцией
+            if isinstance(item, slice) and not self.raced:
+                self.raced = True
+                bot.init_db()
+            return super().__getitem__(item)
+
+    monkeypatch.setattr(bot, 'MIGRATIONS', RacingMigrations(counted(n, m) for n, m in enumerate(bot.MIGRATIONS, start=1)))
+    bot.init_db()
+
+    assert runs == list(range(1, len(bot.MIGRATIONS) + 1))
+    conn = bot._db_connect()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(bot.MIGRATIONS)
+    conn.close()
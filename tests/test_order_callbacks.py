@@ -0,0 +1,75 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+from conftest import seed_product, seed_users
+
+STRANGER = 555
+
+
+class FakeMessage:
+    def __init__(self, chat_id):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+
+    async def edit_text(self, text, **kwargs):
+        self.sent.append(text)
+
+
+class FakeQuery:
+    def __init__(self, data, user_id, chat_id):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, username=f'u{user_id}')
+        self.message = FakeMessage(chat_id)
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+def seed_paid_order() -> int:
+    seed_users(1)
+    product_id = seed_product(1000)
+    conn = bot._db_connect()
+    order_id = conn.execute("INSERT INTO orders (user_id, product_id, price, status, created_at, pubg_id) "
+                            "VALUES (1, ?, 1000, 'paid', ?, '5123456789')", (product_id, bot.now_iso())).lastrowid
+    conn.close()
+    return order_id
+
+
+def press(data, user_id, chat_id) -> FakeQuery:
+    query = FakeQuery(data, user_id, chat_id)
+    asyncio.run(bot.callback_router(SimpleNamespace(callback_query=query), SimpleNamespace(bot_data={})))
+    return query
+
+
+def test_forged_callbacks_from_private_chat_are_rejected(db):
+    order_id = seed_paid_order()
+    for data in (f'take:{order_id}', f'status:{order_id}:in_progress', f'status:{order_id}:done',
+                 f'leave:{order_id}', f'detail_order:{order_id}'):
+        query = press(data, STRANGER, STRANGER)
+        assert query.answers == ["⛔ Недоступно"]
+        # Карточка с username и PUBG ID покупателя не утекает
+        assert query.message.sent == []
+    asyncio.run(bot.settle_done_orders())
+
+    conn = bot._db_connect()
+    assert conn.execute('SELECT status FROM orders WHERE id=?', (order_id,)).fetchone()[0] == 'paid'
+    assert conn.execute('SELECT COUNT(*) FROM order_workers').fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM worker_payouts').fetchone()[0] == 0
+    conn.close()
+
+
+def test_admin_chat_can_take_and_finish_order(db):
+    order_id = seed_paid_order()
+    assert press(f'take:{order_id}', 777, bot.ADMIN_CHAT_ID).answers == [f"✅ Вы взяли заказ #{order_id}"]
+    assert press(f'status:{order_id}:done', 777, bot.ADMIN_CHAT_ID).answers == ["Статус обновлён"]
+    asyncio.run(bot.settle_done_orders())
+
+    conn = bot._db_connect()
+    assert conn.execute('SELECT status FROM orders WHERE id=?', (order_id,)).fetchone()[0] == 'done'
+    assert conn.execute('SELECT worker_id FROM worker_payouts').fetchall() == [(777,)]
+    conn.close()
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, ChatMigrated, Conflict, Forbidden
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def no_intervals(monkeypatch):
+    monkeypatch.setattr(bot, 'TG_PRIVATE_INTERVAL', 0)
+    monkeypatch.setattr(bot, 'TG_GROUP_INTERVAL', 0)
+    monkeypatch.setattr(bot, 'TG_GLOBAL_RATE', 100000)
+
+
+class FakeBot:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        error = self.errors.get(chat_id)
+        if error is not None:
+            raise error
+        self.sent.append((chat_id, text))
+
+
+def run(queue, sends):
+    async def scenario():
+        for chat_id, text in sends:
+            queue.send(chat_id, text, parse_mode='HTML')
+        await queue.close()
+    asyncio.run(scenario())
+
+
+def test_unexpected_telegram_error_does_not_leak_pending():
+    fake = FakeBot({1: Conflict('boom'), 2: Forbidden('blocked'), 3: BadRequest('chat not found')})
+    queue = bot.OutboundQueue(fake)
+    run(queue, [(chat, f'm{i}') for i in range(5) for chat in (1, 2, 3, 4)])
+    assert queue.pending == 0
+    assert not queue._chats and not queue._tasks
+    assert fake.sent == [(4, f'm{i}') for i in range(5)]
+
+
+def test_chat_migration_is_followed():
+    fake = FakeBot({-100: ChatMigrated(-100200)})
+    queue = bot.OutboundQueue(fake)
+    run(queue, [(-100, 'a'), (-100, 'b')])
+    run(queue, [(-100, 'c')])
+    assert fake.sent == [(-100200, 'a'), (-100200, 'b'), (-100200, 'c')]
+    assert queue.pending == 0
+
+
+def test_cancelled_drain_releases_pending():
+    class SlowBot(FakeBot):
+        async def send_message(self, chat_id, text, **kwargs):
+            await asyncio.sleep(10)
+
+    async def scenario():
+        queue = bot.OutboundQueue(SlowBot())
+        for i in range(10):
+            queue.send(1, f'm{i}', parse_mode='HTML')
+        await asyncio.sleep(0.01)
+        await queue.close(timeout=0.01)
+        await asyncio.sleep(0)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.pending == 0
+
+
+def test_plain_texts_are_coalesced():
+    fake = FakeBot()
+    queue = bot.OutboundQueue(fake)
+
+    async def scenario():
+        for i in range(3):
+            queue.send(7, f'm{i}')
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert fake.sent == [(7, 'm0\n\nm1\n\nm2')]
+
+
+def test_next_slot_is_pruned():
+    fake = FakeBot()
+    queue = bot.OutboundQueue(fake)
+    run(queue, [(chat, 'x') for chat in range(1, 3000)])
+    assert len(fake.sent) == 2999
+    assert len(queue._next_slot) < 1100
@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+import bot
+from conftest import seed_product, seed_users
+
+INVITER = 10 ** 6
+ORDERS = 200
+DUPLICATES = 10
+PRICE = 100
+
+
+def seed_orders(product_id: int) -> None:
+    conn = bot._db_connect()
+    conn.execute('INSERT INTO users (tg_id, username, registered_at, balance) VALUES (?, ?, ?, 0)', (INVITER, 'inviter', bot.now_iso()))
+    conn.executemany("INSERT INTO orders (user_id, product_id, price, status, created_at) VALUES (?, ?, ?, 'pending_payment', ?)",
+                     [(user_id, product_id, PRICE, bot.now_iso()) for user_id in range(1, ORDERS + 1)])
+    conn.close()
+
+
+def signed(payload: dict):
+    body = json.dumps(payload).encode()
+    signature = hmac.new(bot.PAYMENT_PROVIDERS['lava']._key, msg=body, digestmod=hashlib.sha256).hexdigest()
+    return body, {'Signature': signature, 'Content-Type': 'application/json'}
+
+
+async def deliver_all(payloads) -> list:
+    app = web.Application()
+    app.router.add_post('/lava_webhook', bot.handle_lava_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/lava_webhook"
+    # Event модуля привязывается к первому loop, а каждый тест запускает свой
+    bot.inbox_wakeup = asyncio.Event()
+    consumer = asyncio.create_task(bot.inbox_consumer())
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100)) as session:
+            async def post(payload):
+                body, headers = signed(payload)
+                async with session.post(url, data=body, headers=headers) as resp:
+                    return resp.status
+            statuses = await asyncio.gather(*(post(p) for p in payloads))
+        deadline = time.monotonic() + 60
+        while (await bot.db_execute('SELECT COUNT(*) FROM webhook_inbox WHERE processed_at IS NULL', fetch=True))[0][0]:
+            assert time.monotonic() < deadline and not consumer.done(), "inbox was not drained"
+            await asyncio.sleep(0.05)
+    finally:
+        consumer.cancel()
+        await runner.cleanup()
+    return statuses
+
+
+def test_duplicate_webhooks_credit_exactly_once(db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, 'notify', lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+    seed_users(ORDERS, invited_by=INVITER)
+    seed_orders(seed_product(PRICE))
+
+    payloads = [{'orderId': order_id, 'status': 'success', 'invoice_id': f'inv-{order_id}', 'sum': PRICE}
+                for order_id in range(1, ORDERS + 1) for _ in range(DUPLICATES)]
+    # Второй платёж с другим id по части уже оплаченных заказов
+    payloads += [{'orderId': order_id, 'status': 'success', 'invoice_id': f'again-{order_id}', 'sum': PRICE} for order_id in range(1, 21)]
+    statuses = asyncio.run(deliver_all(payloads))
+
+    assert set(statuses) == {200}
+    conn = bot._db_connect()
+    assert conn.execute('SELECT balance FROM users WHERE tg_id=?', (INVITER,)).fetchone()[0] == ORDERS * PRICE * bot.REFERRAL_PERCENT
+    assert conn.execute("SELECT COUNT(*) FROM orders WHERE status='paid'").fetchone()[0] == ORDERS
+    assert conn.execute('SELECT COUNT(*) FROM payment_events').fetchone()[0] == ORDERS + 20
+    assert conn.execute('SELECT SUM(orders_paid), SUM(revenue) FROM daily_stats').fetchone() == (ORDERS, ORDERS * PRICE)
+    conn.close()
+
+    admin = [text for chat_id, text in sent if chat_id == bot.ADMIN_CHAT_ID]
+    assert sum('НОВЫЙ ЗАКАЗ' in text for text in admin) == ORDERS
+    alerts = [text for text in admin if 'ручная проверка' in text]
+    assert len(alerts) == 20
+    assert all('статусе paid' in text and 'again-' in text for text in alerts)
+    assert sum(chat_id == INVITER for chat_id, _ in sent) == ORDERS
+
+
+def test_underpaid_order_stays_unpaid(db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, 'notify', lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+    seed_users(ORDERS, invited_by=INVITER)
+    seed_orders(seed_product(PRICE))
+
+    payloads = [{'orderId': 1, 'status': 'success', 'invoice_id': 'low', 'sum': PRICE - 1},
+                {'orderId': 2, 'status': 'success', 'invoice_id': 'exact', 'sum': f'{PRICE:.2f}'},
+                {'orderId': 3, 'status': 'success', 'invoice_id': 'more', 'amount': PRICE + 50},
+                {'orderId': 4, 'status': 'success', 'invoice_id': 'nosum'}]
+    statuses = asyncio.run(deliver_all(payloads))
+    assert statuses == [200, 200, 200, 400]
+
+    conn = bot._db_connect()
+    assert conn.execute('SELECT id, status FROM orders WHERE id <= 4 ORDER BY id').fetchall() == [
+        (1, 'pending_payment'), (2, 'paid'), (3, 'paid'), (4, 'pending_payment')]
+    assert conn.execute('SELECT balance FROM users WHERE tg_id=?', (INVITER,)).fetchone()[0] == 2 * PRICE * bot.REFERRAL_PERCENT
+    conn.close()
+    alerts = [text for chat_id, text in sent if chat_id == bot.ADMIN_CHAT_ID and 'Недоплата' in text]
+    assert len(alerts) == 1 and '#1' in alerts[0] and 'lava:low' in alerts[0]
+
+
+def test_cloudtips_amount_is_parsed():
+    provider = bot.CloudTipsProvider('secret')
+    assert provider.parse({'payload': '7', 'status': 'PAID', 'transactionId': 55, 'amount': 99.5}) == ('55', 7, 99.5)
+    assert provider.parse({'payload': '7', 'status': 'DECLINED', 'amount': 99.5}) is None
+
+
+def run_consumer(seconds: float) -> None:
+    async def scenario():
+        bot.inbox_wakeup = asyncio.Event()
+        consumer = asyncio.create_task(bot.inbox_consumer())
+        await asyncio.sleep(seconds)
+        consumer.cancel()
+    asyncio.run(scenario())
+
+
+def test_failing_event_backs_off_and_alerts_on_last_attempt(db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, 'notify', lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+    monkeypatch.setattr(bot, 'INBOX_POLL_INTERVAL', 0.01)
+
+    async def busy(order_id, event_id, provider='lava', amount=None):
+        if event_id == 'busy':
+            raise bot.sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(bot, 'process_successful_payment', busy)
+    conn = bot._db_connect()
+    # Соседние события проходят успешно — упавшее не должно повторяться на каждом проходе
+    conn.executemany('INSERT INTO webhook_inbox (provider, event_id, order_id, amount, received_at) VALUES (?, ?, ?, ?, ?)',
+                     [('lava', event_id, order_id, PRICE, bot.now_iso()) for order_id, event_id in ((7, 'busy'), (8, 'ok-1'), (9, 'ok-2'))])
+
+    run_consumer(0.3)
+    attempts, next_attempt_at = conn.execute("SELECT attempts, next_attempt_at FROM webhook_inbox WHERE event_id='busy'").fetchone()
+    assert attempts == 1 and next_attempt_at > bot.now_iso()
+    assert conn.execute('SELECT COUNT(*) FROM webhook_inbox WHERE processed_at IS NOT NULL').fetchone()[0] == 2
+    assert sent == []
+
+    # Последняя попытка: событие больше не повторяется, админы получают алерт
+    conn.execute("UPDATE webhook_inbox SET attempts=?, next_attempt_at=NULL WHERE event_id='busy'", (bot.INBOX_MAX_ATTEMPTS - 1,))
+    run_consumer(0.3)
+    assert conn.execute("SELECT attempts FROM webhook_inbox WHERE event_id='busy'").fetchone()[0] == bot.INBOX_MAX_ATTEMPTS
+    conn.close()
+    assert len(sent) == 1
+    chat_id, text = sent[0]
+    assert chat_id == bot.ADMIN_CHAT_ID and 'lava:busy' in text and '#7' in text
+
+
+def test_paid_order_without_buyer_alerts_admins(db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, 'notify', lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+    product_id = seed_product(PRICE)
+    conn = bot._db_connect()
+    order_id = conn.execute("INSERT INTO orders (user_id, product_id, price, status, created_at, pubg_id) "
+                            "VALUES (999, ?, ?, 'pending_payment', ?, '5123')", (product_id, PRICE, bot.now_iso())).lastrowid
+    asyncio.run(bot.process_successful_payment(order_id, 'lava:orphan', 'lava', PRICE))
+
+    assert conn.execute('SELECT status FROM orders WHERE id=?', (order_id,)).fetchone()[0] == 'paid'
+    conn.close()
+    assert len(sent) == 1
+    chat_id, text = sent[0]
+    assert chat_id == bot.ADMIN_CHAT_ID and f'#{order_id}' in text and 'lava:orphan' in text and '5123' in text
@@ -0,0 +1,66 @@
+import asyncio
+
+import bot
+from conftest import seed_product, seed_users
+
+USERS = 3000
+ACTIVATIONS = 50
+
+
+def seed_promo(activations: int) -> None:
+    conn = bot._db_connect()
+    conn.execute("INSERT INTO promocodes (code, discount_percent, activations_left) VALUES ('LOAD', 10, ?)", (activations,))
+    conn.close()
+
+
+async def redeem(product_id: int, user_ids) -> list:
+    async def one(user_id):
+        try:
+            return await bot.db_transaction(bot._create_order_tx, user_id, product_id, 90, None, 'LOAD')
+        except bot.PromoUnavailable:
+            return None
+    return await asyncio.gather(*(one(u) for u in user_ids))
+
+
+def counts(conn) -> tuple:
+    return (conn.execute("SELECT activations_left FROM promocodes WHERE code='LOAD'").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM orders WHERE promo_code='LOAD' AND status='pending_payment'").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM used_promocodes WHERE code='LOAD'").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM promo_reservations WHERE code='LOAD'").fetchone()[0])
+
+
+def test_concurrent_redemptions_never_exceed_activations(db):
+    seed_users(USERS)
+    seed_promo(ACTIVATIONS)
+    product_id = seed_product()
+    # Каждый пользователь жмёт «Купить» дважды: вторая попытка упирается в used_promocodes
+    orders = asyncio.run(redeem(product_id, list(range(1, USERS + 1)) * 2))
+    won = [o for o in orders if o is not None]
+    assert len(won) == ACTIVATIONS
+
+    conn = bot._db_connect()
+    assert counts(conn) == (0, ACTIVATIONS, ACTIVATIONS, ACTIVATIONS)
+    assert conn.execute("SELECT COUNT(DISTINCT user_id) FROM orders WHERE promo_code='LOAD'").fetchone()[0] == ACTIVATIONS
+    conn.close()
+
+
+def test_abandoned_orders_return_activations(db):
+    seed_users(USERS)
+    seed_promo(ACTIVATIONS)
+    product_id = seed_product()
+
+    async def scenario():
+        won = [o for o in await redeem(product_id, range(1, USERS + 1)) if o is not None]
+        # Половина счетов не создалась — заказы отменяются параллельно с новыми попытками
+        retry = redeem(product_id, range(1, USERS + 1))
+        abandon = asyncio.gather(*(bot.db_transaction(bot._abandon_order_tx, o) for o in won[:ACTIVATIONS // 2]))
+        again, _ = await asyncio.gather(retry, abandon)
+        return [o for o in again if o is not None]
+
+    again = asyncio.run(scenario())
+    assert len(again) <= ACTIVATIONS // 2
+    conn = bot._db_connect()
+    left, pending, used, reserved = counts(conn)
+    assert pending == used == reserved == ACTIVATIONS - ACTIVATIONS // 2 + len(again)
+    assert left + pending == ACTIVATIONS
+    conn.close()
@@ -0,0 +1,85 @@
+import asyncio
+import random
+
+import pytest
+
+import bot
+from conftest import seed_product
+
+INBOX_QUERY = ('SELECT id, provider, event_id, order_id, amount, attempts FROM webhook_inbox '
+               'WHERE processed_at IS NULL AND attempts < ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?) '
+               'ORDER BY id LIMIT ?')
+
+# Горячие запросы и индекс, которым каждый обязан пользоваться
+HOT_QUERIES = [
+    ('SELECT id, pubg_id, balance, (SELECT COUNT(*) FROM users r WHERE r.invited_by = u.tg_id) FROM users u WHERE tg_id=?',
+     (5,), ['sqlite_autoindex_users_1', 'idx_users_invited_by']),
+    ('SELECT invited_by, username, tg_id FROM users WHERE id=?', (5,), ['INTEGER PRIMARY KEY']),
+    ('SELECT id, price, status FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 5', (5,), ['COVERING INDEX idx_orders_user']),
+    ('SELECT 1 FROM used_promocodes WHERE user_id=? AND code=?', (5, 'X'), ['sqlite_autoindex_used_promocodes_1']),
+    ('SELECT worker_id, worker_username FROM order_workers WHERE order_id=? ORDER BY id', (5,), ['idx_order_workers_unique']),
+    ('SELECT 1 FROM order_workers WHERE order_id=? AND worker_id=?', (5, 7), ['COVERING INDEX idx_order_workers_unique']),
+    (INBOX_QUERY, (5, '2030', 100), ['idx_webhook_inbox_pending']),
+    ("SELECT id FROM orders WHERE status='pending_payment' AND created_at < ? LIMIT ?", ('2030', 100), ['idx_orders_pending']),
+    ("SELECT id, price FROM orders INDEXED BY idx_orders_unsettled WHERE status='done' AND settled_at IS NULL ORDER BY id LIMIT ?",
+     (100,), ['idx_orders_unsettled']),
+    ('SELECT o.id, o.status, o.price, o.created_at, o.pubg_id, u.username FROM orders o LEFT JOIN users u ON u.id = o.user_id '
+     'WHERE o.status=? ORDER BY o.id DESC LIMIT ?', ('paid', 10), ['idx_orders_status_id', 'INTEGER PRIMARY KEY']),
+]
+
+
+@pytest.fixture
+def seeded(db):
+    # Реалистичное распределение, чтобы ANALYZE дал планировщику настоящую статистику
+    product_id = seed_product()
+    conn = bot._db_connect()
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO users (tg_id, username, registered_at, balance, invited_by) VALUES (?, ?, ?, 0, ?)',
+                     [(i, f'u{i}', bot.now_iso(), random.randint(1, i - 1) if i % 3 == 0 else None) for i in range(1, 5001)])
+    conn.executemany('INSERT INTO orders (user_id, product_id, price, status, created_at) VALUES (?, ?, 100, ?, ?)',
+                     [(random.randint(1, 5000), product_id, random.choice(('done', 'done', 'paid', 'expired', 'pending_payment')),
+                       bot.now_iso()) for _ in range(20000)])
+    conn.execute('COMMIT')
+    conn.execute('ANALYZE')
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('query, params, indexes', HOT_QUERIES, ids=[q[0][:60] for q in HOT_QUERIES])
+def test_hot_query_uses_index(seeded, query, params, indexes):
+    steps = [row[-1] for row in seeded.execute('EXPLAIN QUERY PLAN ' + query, params)]
+    plan = ' | '.join(steps)
+    for index in indexes:
+        assert index in plan, plan
+    # Полный проход по users/orders недопустим; проход по частичному индексу (только нужные строки) — можно
+    for step in steps:
+        if step.startswith(('SCAN users', 'SCAN orders')):
+            assert 'USING' in step and any(index in step for index in indexes), plan
+    if 'LIMIT' in query:
+        # Страничные выборки должны идти по порядку индекса, а не сортировать всё подходящее
+        assert 'USE TEMP B-TREE' not in plan, plan
+
+
+def test_settlement_query_matches_code(seeded):
+    # Запрос в HOT_QUERIES должен быть тем же, что в _settle_orders_tx
+    statements = []
+    seeded.set_trace_callback(statements.append)
+    seeded.execute('BEGIN')
+    bot._settle_orders_tx(seeded)
+    seeded.execute('ROLLBACK')
+    assert any('INDEXED BY idx_orders_unsettled' in s for s in statements)
+
+
+def test_inbox_query_matches_code(monkeypatch):
+    # INBOX_QUERY должен быть тем же, что выполняет inbox_consumer
+    queries = []
+
+    async def capture(query, params=(), fetch=False):
+        queries.append(query)
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(bot, 'db_execute', capture)
+    monkeypatch.setattr(bot, 'inbox_wakeup', asyncio.Event())
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(bot.inbox_consumer())
+    assert queries == [INBOX_QUERY]
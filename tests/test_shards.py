@@ -0,0 +1,55 @@
+import queue
+
+import bot
+
+
+class FakeProc:
+    def __init__(self, alive=True):
+        self.alive, self.exitcode = alive, None if alive else -9
+
+    def is_alive(self):
+        return self.alive
+
+
+def test_cache_bump_goes_to_the_owning_shard(monkeypatch):
+    shards = [queue.Queue() for _ in range(3)]
+    monkeypatch.setattr(bot, 'update_shards', shards)
+    bot.bump_user_cache(7, 'ref_count', 1)
+    assert shards[1].get_nowait() == ('invalidate', 7)
+    assert shards[0].empty() and shards[2].empty()
+
+
+def test_cache_bump_from_a_shard_goes_through_the_relay(monkeypatch):
+    relay = queue.Queue()
+    monkeypatch.setattr(bot, 'worker_relay', relay)
+    bot.RelayOutbox(relay).send(5, 'hi', parse_mode='HTML')
+    bot.bump_user_cache(7, 'balance', 10)
+    assert relay.get_nowait() == ('notify', 5, 'hi', {'parse_mode': 'HTML'})
+    assert relay.get_nowait() == ('invalidate', 7)
+
+
+def test_cache_bump_in_single_process_is_write_through(monkeypatch):
+    monkeypatch.setattr(bot, 'update_shards', [])
+    bot.user_cache.put(7, {'id': 1, 'pubg_id': None, 'balance': 0.0, 'ref_count': 0})
+    bot.bump_user_cache(7, 'balance', 10)
+    assert bot.user_cache.get(7)['balance'] == 10
+    bot.user_cache.invalidate(7)
+    assert bot.user_cache.get(7) is None
+
+
+def test_dead_worker_is_restarted_with_backoff(monkeypatch):
+    spawned = []
+    monkeypatch.setattr(bot, '_spawn_update_worker', lambda shard, q, relay: spawned.append((shard, q)) or FakeProc())
+    old_queue = bot.multiprocessing.get_context('spawn').Queue()
+    monkeypatch.setattr(bot, 'update_shards', [None, old_queue])
+    monkeypatch.setattr(bot, 'update_workers', [FakeProc(), FakeProc(alive=False)])
+    monkeypatch.setattr(bot, '_worker_restarted_at', {})
+
+    assert bot.ensure_update_worker(0) and not spawned
+    assert bot.ensure_update_worker(1)
+    assert spawned == [(1, bot.update_shards[1])] and bot.update_shards[1] is not old_queue
+
+    # Новый процесс тоже упал сразу — до конца паузы апдейты получают 503
+    bot.update_workers[1] = FakeProc(alive=False)
+    assert not bot.ensure_update_worker(1)
+    assert len(spawned) == 1
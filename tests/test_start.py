@@ -0,0 +1,38 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+from conftest import seed_users
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def run_start(tg_id: int) -> FakeMessage:
+    message = FakeMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=tg_id, username=f'u{tg_id}', first_name='U'),
+                             message=message)
+    context = SimpleNamespace(args=[], bot=SimpleNamespace(username='metro_shop_bot'))
+    asyncio.run(bot.start(update, context))
+    return message
+
+
+def test_start_unblocks_returning_user(db):
+    seed_users(2)
+    conn = bot._db_connect()
+    conn.execute('UPDATE users SET blocked_at=? WHERE tg_id IN (1, 2)', (bot.now_iso(),))
+    # Профиль уже в кэше — start идёт по ветке существующего пользователя
+    asyncio.run(bot.get_user_profile(1))
+    assert bot.user_cache.get(1) is not None
+
+    message = run_start(1)
+    assert message.replies
+    blocked = dict(conn.execute('SELECT tg_id, blocked_at FROM users').fetchall())
+    conn.close()
+    assert blocked[1] is None
+    assert blocked[2] is not None
@@ -0,0 +1,60 @@
+import asyncio
+
+from telegram import Update
+
+import bot
+
+
+def update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'x', 'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'u'}}}, None)
+
+
+def test_chat_order_and_fairness():
+    async def scenario():
+        processor = bot.PerChatUpdateProcessor(2)
+        done = []
+
+        async def handle(u: Update, delay: float):
+            await asyncio.sleep(delay)
+            done.append((u.effective_chat.id, u.update_id))
+
+        # Чат 1 завален медленными апдейтами; чат 2 не должен ждать, пока они разойдутся
+        flood = [processor.process_update(u, handle(u, 0.01)) for u in (update(i, 1) for i in range(30))]
+        other = [processor.process_update(u, handle(u, 0)) for u in (update(100 + i, 2) for i in range(3))]
+        await asyncio.gather(*flood, *other)
+        return processor, done
+
+    processor, done = asyncio.run(scenario())
+    chat1 = [uid for chat, uid in done if chat == 1]
+    assert chat1 == list(range(30))
+    assert [uid for chat, uid in done if chat == 2] == [100, 101, 102]
+    assert done.index((2, 102)) < 5
+    assert processor.stats == {'processed': 33, 'timeouts': 0, 'queued': 0, 'max_chat_depth': 30}
+    assert not processor._chat_locks and not processor._chat_depth
+
+
+def test_concurrency_limit_and_timeout(monkeypatch):
+    monkeypatch.setattr(bot, 'HANDLER_TIMEOUT', 0.05)
+
+    async def scenario():
+        processor = bot.PerChatUpdateProcessor(3)
+        running = peak = 0
+
+        async def handle(delay: float):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                running -= 1
+
+        await asyncio.gather(*(processor.process_update(update(i, i), handle(0.01)) for i in range(20)))
+        await processor.process_update(update(99, 99), handle(1))
+        return processor, peak
+
+    processor, peak = asyncio.run(scenario())
+    assert peak == 3
+    assert processor.stats['timeouts'] == 1 and processor.stats['processed'] == 21